@@ -4,25 +4,169 @@
 import ConfigParser
 import argparse
 import ast
+import collections
 import datetime
 import ftplib
+import gzip
+import hashlib
 import itertools
+import json
 import logging
 import math
 import os
+import Queue
 import sys
-from StringIO import StringIO
+import threading
+import time
 
-from orm import automap
-
-logging.basicConfig(level=logging.DEBUG,
-                    filename='/tmp/abaita.log',
-                    filemode='a',
-                    format='%(asctime)s.%(msecs)03d|%(levelname)-8s|%(name)s|%(filename)s:%(lineno)d|%(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+from metrics import Metrics
 
 eight_hours = datetime.timedelta(hours=8)
 
+checkpoint_file = os.path.expanduser('~/.abaita.state')
+guard_size = 1024
+batch_size = 1000
+
+Punch = collections.namedtuple('Punch', 'badge date time uscita')
+
+# Columns and their type of the exported files, see write_export()
+export_schemas = {
+    'punches': [('badge', 'string'), ('date', 'date'), ('time', 'time'), ('uscita', 'bool')],
+    'summaries': [('badge', 'string'), ('date', 'date'), ('worked_minutes', 'int'), ('worked_maw_minutes', 'int'),
+                  ('punches', 'int'), ('anomaly', 'bool')],
+}
+export_extensions = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+# Same columns as abaita.sql, the raw lines are copied inline
+local_schema = [
+    'CREATE TABLE IF NOT EXISTS abaita ('
+    'date date NOT NULL, "time" time NOT NULL, badge varchar NOT NULL, uscita boolean NOT NULL, raw varchar, '
+    'PRIMARY KEY (date, "time", badge))',
+    'CREATE INDEX IF NOT EXISTS abaita_badge_date_time_idx ON abaita (badge, date, "time", uscita)',
+    # Per badge, the latest inserted_at of the central rows synced, as text with its time zone
+    'CREATE TABLE IF NOT EXISTS sync_state (badge varchar PRIMARY KEY, inserted_at varchar NOT NULL)',
+]
+
+
+def configure_logging():
+    logging.basicConfig(level=logging.DEBUG,
+                        filename='/tmp/abaita.log',
+                        filemode='a',
+                        format='%(asctime)s.%(msecs)03d|%(levelname)-8s|%(name)s|%(filename)s:%(lineno)d|%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def conf_get(conf, section, option, default=None):
+    if conf.has_option(section, option):
+        return conf.get(section, option)
+    return default
+
+
+def engine_options(conf, database):
+    options = {}
+    postgresql = database.split(':', 1)[0].split('+')[0] == 'postgresql'
+    for option, convert, everywhere in (
+        ('pool_size', int, False),
+        ('max_overflow', int, False),
+        ('pool_timeout', float, False),
+        ('pool_recycle', int, True),
+        ('pool_pre_ping', ast.literal_eval, True),
+        ('statement_timeout', int, False),
+    ):
+        # The SQLite pools do not take the size and timeout of the queue pool
+        if not (postgresql or everywhere):
+            continue
+        value = conf_get(conf, 'database', option)
+        if value:
+            options[option] = convert(value)
+    options['replicas'] = conf_get(conf, 'database', 'replicas', '').split()
+    return options
+
+
+def configure_cache(conf):
+    from orm import CFileCacheStore, QueryCache
+
+    # Shared between the invocations, so that a scrape invalidates what print cached
+    path = conf_get(conf, 'cache', 'path')
+    if path:
+        QueryCache.set_store(CFileCacheStore(
+            os.path.expanduser(path),
+            max_entries=int(conf_get(conf, 'cache', 'max_entries', 1024)),
+            ttl=float(conf_get(conf, 'cache', 'ttl', 300)),
+        ))
+
+
+def configure_metrics(conf, args):
+    # Empty to disable the export
+    path = conf_get(conf, 'metrics', 'path')
+    Metrics.configure(os.path.expanduser(path) if path else None,
+                      format=conf_get(conf, 'metrics', 'format', 'json'),
+                      command=args.func.__name__)
+
+
+def get_tables(conf, args):
+    from orm import automap
+    from storage import PunchMixin
+
+    configure_cache(conf)
+    database = args.database or conf.get('database', 'endpoint')
+    # Empty to disable the reflection cache
+    cache_dir = conf_get(conf, 'database', 'cache', '~/.cache/abaita')
+    cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+    return automap('abaita', database, only=['abaita', 'daily_summary'], cache_dir=cache_dir,
+                   mixins=dict(abaita=PunchMixin), **engine_options(conf, database))
+
+
+def get_local_tables(conf):
+    """
+    The tables of the local store filled by sync, created if they are not there yet.
+    """
+    from orm import SessionPool, automap
+    from storage import PunchMixin
+
+    path = conf_get(conf, 'local', 'path')
+    if not path:
+        logging.error(u"No local store, see [local] in .abaita.rc")
+        sys.exit(1)
+    path = os.path.expanduser(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    tables = automap('local', 'sqlite:///{}'.format(path), only=['abaita', 'daily_summary'], mixins=dict(abaita=PunchMixin))
+    engine = SessionPool.get_engine('local')
+    for statement in local_schema:
+        engine.execute(statement)
+    return tables
+
+
+def get_abaita(conf, args):
+    return get_punches(get_tables(conf, args))
+
+
+def get_punches(tables):
+    with Metrics.span('reflection'):
+        return tables['abaita']
+
+
+def get_summary(tables):
+    from sqlalchemy.exc import InvalidRequestError
+
+    try:
+        with Metrics.span('reflection'):
+            return tables['daily_summary']
+    except InvalidRequestError:
+        logging.warning(u"No daily_summary table in the database, see abaita.sql")
+        return None
+
+
+def batches(iterable, size=batch_size):
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            break
+        yield batch
+
 
 def mawify(dt, uscita):
     if isinstance(dt, int):
@@ -33,8 +177,9 @@ def mawify(dt, uscita):
         dt = dt.replace(minute=0)
     if 26 <= dt.minute <= 34:
         dt = dt.replace(minute=30)
+    # Adding the hour, as 23 + 1 rolls over to the next day
     if 56 <= dt.minute:
-        dt = dt.replace(minute=0, hour=(dt.hour + 1))
+        dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
 
     if uscita:
         rounded = int(math.floor(dt.minute / 30.0) * 30)
@@ -42,15 +187,179 @@ def mawify(dt, uscita):
     else:
         rounded = int(math.ceil(dt.minute / 30.0) * 30)
         if rounded == 60:
-            dt = dt.replace(second=0, minute=0, hour=(dt.hour + 1))
+            dt = dt.replace(second=0, minute=0) + datetime.timedelta(hours=1)
         else:
             dt = dt.replace(second=0, minute=rounded)
 
     return dt
 
 
-def print_day(date, rows, maw=False):
-    rows = sorted((datetime.datetime.combine(r.date, r.time), r.uscita) for r in rows)
+def mawify_many(times, uscite):
+    """
+    mawify() on whole arrays in a single NumPy pass: times are a datetime64 array or
+    a sequence of datetime, uscite booleans. Return an array of datetime64[us],
+    the same results as mawify(), see bench/mawify.py.
+    """
+    import numpy
+
+    if isinstance(times, numpy.ndarray):
+        times = times.astype('datetime64[us]')
+    else:
+        # Way faster than letting numpy.asarray convert the datetime objects
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        times = numpy.fromiter((
+            ((t.toordinal() - epoch) * 86400 + t.hour * 3600 + t.minute * 60 + t.second) * 1000000 + t.microsecond
+            for t in times
+        ), numpy.int64).view('datetime64[us]')
+    uscite = numpy.asarray(uscite, dtype=bool)
+
+    hours = times.astype('datetime64[h]')
+    # mawify() drops the seconds but keeps the microseconds
+    microseconds = times - times.astype('datetime64[s]')
+    minutes = (times - hours).astype('timedelta64[m]').astype(numpy.int64)
+
+    minutes[minutes <= 4] = 0
+    minutes[(26 <= minutes) & (minutes <= 34)] = 30
+    # 60 is the next hour, both when rounding down and up
+    minutes[56 <= minutes] = 60
+
+    rounded = numpy.where(uscite, minutes // 30 * 30, -(-minutes // 30) * 30)
+    return hours + rounded.astype('timedelta64[m]') + microseconds
+
+
+def mawify_days(days):
+    """
+    Mawify the (datetime, uscita) punches of many days at once, with NumPy if available.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return [[mawify(*p) for p in punches] for punches in days]
+
+    punches = [p for day in days for p in day]
+    if not punches:
+        return [[] for day in days]
+    mawified = mawify_many(*zip(*punches)).tolist()
+
+    result, start = [], 0
+    for day in days:
+        result.append(mawified[start:start + len(day)])
+        start += len(day)
+    return result
+
+
+def worked_time(times):
+    return sum((end - start for start, end in zip(times[::2], times[1::2])), datetime.timedelta())
+
+
+def summarize_day(punches, mawified=None):
+    """
+    Worked time, worked time according to maw, number of punches and anomaly flag
+    of a day, given its (datetime, uscita) punches sorted by time.
+    A day is anomalous unless it has exactly an entry, an exit, an entry and an exit.
+    """
+    times, uscite = zip(*punches)
+    if mawified is None:
+        mawified = [mawify(*p) for p in punches]
+    anomaly = list(uscite) != [False, True, False, True]
+    return worked_time(times), worked_time(mawified), len(times), anomaly
+
+
+def summarize(rows):
+    """
+    Yield a daily_summary row for every day of rows, which must be sorted by badge, date and time.
+    """
+    days = (
+        (badge, date, [(datetime.datetime.combine(date, r.time), r.uscita) for r in punches])
+        for (badge, date), punches in itertools.groupby(rows, key=lambda r: (r.badge, r.date))
+    )
+    # Mawify many days together, it is way faster with NumPy
+    for chunk in batches(days):
+        mawified = mawify_days([punches for badge, date, punches in chunk])
+        for (badge, date, punches), maw in zip(chunk, mawified):
+            worked, worked_maw, count, anomaly = summarize_day(punches, maw)
+            yield dict(badge=badge, date=date, worked=worked, worked_maw=worked_maw, punches=count, anomaly=anomaly)
+
+
+def save_summaries(CSummary, summaries):
+    from sqlalchemy.dialects.postgresql import insert
+
+    table = CSummary.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={c: statement.excluded[c] for c in ('worked', 'worked_maw', 'punches', 'anomaly')},
+    )
+    count = 0
+    for batch in batches(summaries):
+        CSummary.execute(statement.values(batch))
+        count += len(batch)
+    return count
+
+
+def punches_query(CAbaita):
+    from sqlalchemy import select
+
+    table = CAbaita.__table__
+    return select([table.c.badge, table.c.date, table.c.time, table.c.uscita]).order_by(
+        table.c.badge, table.c.date, table.c.time)
+
+
+def update_summaries(CAbaita, CSummary, days):
+    """
+    Recompute the daily_summary rows of the given (badge, date) days.
+    """
+    from sqlalchemy import tuple_
+
+    table = CAbaita.__table__
+    for batch in batches(sorted(set(days))):
+        query = punches_query(CAbaita).where(tuple_(table.c.badge, table.c.date).in_(batch))
+        save_summaries(CSummary, summarize(CAbaita.execute(query)))
+
+
+def format_hours(delta):
+    if delta is None:
+        return '-'
+    minutes = int(delta.total_seconds()) // 60
+    return '{}:{:02d}'.format(minutes // 60, minutes % 60)
+
+
+def print_summary(CSummary, badge, maw=False):
+    from sqlalchemy import select
+
+    table = CSummary.__table__
+    query = select([table]).where(table.c.badge == badge).order_by(table.c.date)
+    with Metrics.span('report_query'):
+        rows = CSummary.execute_cached(query)
+    with Metrics.span('report_render'):
+        print_months(rows, maw)
+
+
+def print_months(rows, maw=False):
+    for month, days in itertools.groupby(rows, key=lambda d: d.date.strftime('%Y-%m')):
+        print "[{}]".format(month)
+        total, total_maw = datetime.timedelta(), datetime.timedelta()
+        for day in days:
+            total += day.worked or datetime.timedelta()
+            total_maw += day.worked_maw or datetime.timedelta()
+            line = "{}\t{}".format(day.date, format_hours(day.worked))
+            if maw:
+                line += "\t=>\t{}".format(format_hours(day.worked_maw))
+            if day.anomaly:
+                line += "\t({} timbrature)".format(day.punches)
+            print line
+        print 'Ore sgobbate: {}'.format(format_hours(total))
+        if maw:
+            print 'Ore sgobbate secondo maw: {}'.format(format_hours(total_maw))
+        print ""
+
+
+def render_day(date, punches, maw=False, worked=None, incomplete=None):
+    """
+    The lines of the report of a day, see print_day().
+    """
+    lines = []
+    rows = sorted(punches)
 
     # Did you know that zip is its own inverse?
     # times, uscite = [r[0] for r in rows], [r[1] for r in rows]
@@ -58,21 +367,24 @@ def print_day(date, rows, maw=False):
 
     mawified = [mawify(*r) for r in rows] if maw else None
 
-    print "[{}]".format(date)
+    lines.append("[{}]".format(date))
 
     if maw:
         for t, m, u in zip(times, mawified, uscite):
-            print "{} {}\t=>\t{}".format(('u' if u else 'e'), t, m)
+            lines.append("{} {}\t=>\t{}".format(('u' if u else 'e'), t, m))
     else:
         for t in times:
-            print t
+            lines.append(str(t))
+
+    if incomplete is None:
+        incomplete = len(times) < 4
 
     if len(times) == 4:
-        hours = (times[3] - times[2]) + (times[1] - times[0])
-        print 'Ore sgobbate: {}'.format(hours)
+        hours = worked if worked is not None else (times[3] - times[2]) + (times[1] - times[0])
+        lines.append('Ore sgobbate: {}'.format(hours))
         if maw:
             hours = (mawified[3] - mawified[2]) + (mawified[1] - mawified[0])
-            print 'Ore sgobbate secondo maw: {}'.format(hours)
+            lines.append('Ore sgobbate secondo maw: {}'.format(hours))
 
     else:
         if maw:
@@ -87,111 +399,1027 @@ def print_day(date, rows, maw=False):
                 hours = ((datetime.datetime.now() - times[2]) + (times[1] - times[0]))
                 expected = datetime.datetime.now() + (eight_hours - hours)
                 ape = "DAI CHE SI FA L'APE!!!!!!" if date.isoweekday() == 5 else ''
-                print 'Siamo a: {} ore... {}'.format(datetime.timedelta(seconds=int(hours.total_seconds())), ape)
+                lines.append('Siamo a: {} ore... {}'.format(datetime.timedelta(seconds=int(hours.total_seconds())), ape))
 
             else:
                 expected = None
 
             if expected:
-                print "Puoi uscire alle {}".format(expected.time())
+                lines.append("Puoi uscire alle {}".format(expected.time()))
+
+        elif incomplete:
+            lines.append("WARNING: non hai timbrato, sciocco!")
+
+    lines.append("")
+    return lines
+
+
+def print_day(date, punches, maw=False, worked=None, incomplete=None):
+    for line in render_day(date, punches, maw=maw, worked=worked, incomplete=incomplete):
+        print line
+
+
+def daily_report_query(CAbaita, badge, date=None):
+    """
+    One row per day: the punches, the worked time and whether the day is incomplete.
+    The worked time pairs every odd punch with the next one, as in (t2 - t1) + (t4 - t3).
+    """
+    from sqlalchemy import case, func, select
+    from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+    table = CAbaita.__table__
+    window = dict(partition_by=table.c.date, order_by=table.c.time)
+    punches = select([
+        table.c.date,
+        table.c.time,
+        table.c.uscita,
+        func.row_number().over(**window).label('n'),
+        func.lead(table.c.time).over(**window).label('following'),
+    ]).where(table.c.badge == badge)
+    if date:
+        punches = punches.where(table.c.date == date)
+    punches = punches.alias('punches')
+
+    return select([
+        punches.c.date,
+        func.array_agg(aggregate_order_by(punches.c.time, punches.c.time)).label('times'),
+        func.array_agg(aggregate_order_by(punches.c.uscita, punches.c.time)).label('uscite'),
+        func.sum(case([(punches.c.n % 2 == 1, punches.c.following - punches.c.time)])).label('worked'),
+        (func.count() < 4).label('incomplete'),
+    ]).group_by(punches.c.date).order_by(punches.c.date)
+
+
+def report_days(CAbaita, badge, date=None, cached=True, readonly=True):
+    """
+    Return date, punches, worked time and incomplete flag of every day of the report,
+    read from a replica if readonly and any is configured.
+    array_agg is PostgreSQL only: elsewhere the punches are grouped here, and
+    print_day() computes the rest.
+    """
+    from orm import SessionPool
+
+    if cached:
+        execute = lambda query: CAbaita.execute_cached(query, readonly=readonly)
+    else:
+        execute = lambda query: CAbaita.execute(query, readonly=readonly)
+    if SessionPool.get_engine(CAbaita.__enginename__).dialect.name == 'postgresql':
+        return [
+            (day.date, [(datetime.datetime.combine(day.date, t), u) for t, u in zip(day.times, day.uscite)],
+             day.worked, day.incomplete)
+            for day in execute(daily_report_query(CAbaita, badge, date))
+        ]
+
+    table = CAbaita.__table__
+    query = punches_query(CAbaita).where(table.c.badge == badge)
+    if date:
+        query = query.where(table.c.date == date)
+    return [
+        (day, [(datetime.datetime.combine(day, p.time), p.uscita) for p in punches], None, None)
+        for day, punches in itertools.groupby(execute(query), key=lambda p: p.date)
+    ]
+
+
+def summarize_badge(item):
+    """
+    Process pool body: the daily summaries of a badge, given its (date, time, uscita) punches sorted by time.
+    """
+    badge, punches = item
+    return badge, list(summarize(Punch(badge, date, time, uscita) for date, time, uscita in punches))
+
+
+def team_summaries(CAbaita, team, since=None, until=None, jobs=None):
+    """
+    Return a list of the badge and the daily summaries of every badge of the team: the punches
+    are read with a single query, the summaries computed in a process pool.
+    """
+    import multiprocessing
+
+    table = CAbaita.__table__
+    query = punches_query(CAbaita).where(table.c.badge.in_(sorted(team)))
+    if since:
+        query = query.where(table.c.date >= since)
+    if until:
+        query = query.where(table.c.date <= until)
+
+    with Metrics.span('report_query'):
+        rows = CAbaita.execute(query, readonly=True).fetchall()
+    badges = [
+        (badge, [(r.date, r.time, r.uscita) for r in punches])
+        for badge, punches in itertools.groupby(rows, key=lambda r: r.badge)
+    ]
+
+    jobs = jobs or multiprocessing.cpu_count()
+    with Metrics.span('report_summaries'):
+        # Forking costs more than summarizing a few thousand punches
+        if jobs == 1 or len(badges) < 2 or len(rows) < 10 * batch_size:
+            results = map(summarize_badge, badges)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(summarize_badge, badges, max(1, len(badges) // (4 * jobs)))
+            finally:
+                pool.terminate()
+    return results
+
 
-        elif len(times) < 4:
-            print "WARNING: non hai timbrato, sciocco!"
+def print_team(CAbaita, team, since=None, until=None, maw=False, as_csv=False, jobs=None):
+    import csv
 
-    print ""
+    results = team_summaries(CAbaita, team, since=since, until=until, jobs=jobs)
+    with Metrics.span('report_render'):
+        if as_csv:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['badge', 'date', 'punches', 'worked', 'worked_maw', 'anomaly'])
+            for badge, days in results:
+                for day in days:
+                    writer.writerow([badge, day['date'], day['punches'], format_hours(day['worked']),
+                                     format_hours(day['worked_maw']), int(day['anomaly'])])
+            return
+
+        def row(badge, date, punches, worked, worked_maw, note=''):
+            values = [badge, date, punches, worked] + ([worked_maw] if maw else []) + [note]
+            print ("{:<8} {:<10} {:>6} {:>7} {:>7} {}" if maw else "{:<8} {:<10} {:>6} {:>7} {}").format(*map(str, values))
+
+        row('Badge', 'Data', 'Timbr.', 'Ore', 'Ore maw')
+        for badge, days in results:
+            total, total_maw = datetime.timedelta(), datetime.timedelta()
+            for day in days:
+                total += day['worked']
+                total_maw += day['worked_maw']
+                row(badge, day['date'], day['punches'], format_hours(day['worked']), format_hours(day['worked_maw']),
+                    '(!)' if day['anomaly'] else '')
+            row(badge, 'Totale', '', format_hours(total), format_hours(total_maw))
+        missing = set(team) - set(badge for badge, days in results)
+        if missing:
+            print "Nessuna timbratura per: {}".format(', '.join(sorted(missing)))
+
+
+def reject_local_summaries(args, summaries):
+    # sync copies the punches only: the local store has no daily_summary
+    if args.local and summaries:
+        logging.error(u"No daily summaries in the local store")
+        sys.exit("Il riepilogo giornaliero non è disponibile con --local")
 
 
 def print_report(conf, args):
-    database = args.database or conf.get('database', 'endpoint')
-    CAbaita = automap('abaita', database)['abaita']
+    reject_local_summaries(args, args.summary)
+    tables = get_local_tables(conf) if args.local else get_tables(conf, args)
+    CAbaita = get_punches(tables)
+
+    if args.team is not None:
+        team = args.team or set(filter(None, map(str.strip, conf.get('whitelist', 'values').split())))
+        if not team:
+            logging.error(u"No badges for the team report")
+            sys.exit("Nessun badge: passali a --team o mettili in [whitelist] values")
+        maw = args.mawify if args.mawify is not None else ast.literal_eval(conf.get('user', 'maw'))
+        since, until = args.since, args.until
+        if not (since or until or args.all):
+            since = until = datetime.date.today()
+        logging.info(u"Printing team report for {} badges from {} to {}".format(len(team), since, until))
+        print_team(CAbaita, team, since=since, until=until, maw=maw, as_csv=args.csv, jobs=args.jobs)
+        return
 
     badge = args.badge or conf.get('user', 'badge')
     maw = args.mawify if args.mawify is not None else ast.literal_eval(conf.get('user', 'maw'))
     logging.info(u"Printing report for badge {}".format(badge))
 
-    if args.all:
-        query = CAbaita.load(badge=badge).order_by(CAbaita.date)
+    if args.summary:
+        CSummary = get_summary(tables)
+        if CSummary is not None:
+            print_summary(CSummary, badge, maw=maw)
+        return
+
+    with Metrics.span('report_query'):
+        # A swipe on another host does not reach this cache: today's report always reads the database
+        days = report_days(CAbaita, badge, date=None if args.all else datetime.date.today(), cached=args.all)
+    with Metrics.span('report_render'):
+        for date, punches, worked, incomplete in days:
+            logging.debug(u"Printing report for day {}".format(date))
+            print_day(date, punches, maw=maw, worked=worked, incomplete=incomplete)
+
+
+def sync(conf, args):
+    from sqlalchemy import select, text
+    from storage import read_block
+
+    CAbaita = get_abaita(conf, args)
+    CLocal = get_punches(get_local_tables(conf))
+
+    central, local = CAbaita.__table__, CLocal.__table__
+    if 'inserted_at' not in central.c:
+        logging.error(u"No inserted_at column in {}, run migrate".format(central.name))
+        sys.exit("Manca la colonna inserted_at: esegui abaita migrate")
+
+    badges = args.badge or conf_get(conf, 'local', 'badges', '').split() or [conf.get('user', 'badge')]
+    # The rows are synced by the time they were inserted, not by the time of the punch, which may
+    # be days older when a site was unreachable. A transaction that commits later than overlap
+    # after it started could still be missed.
+    overlap = float(conf_get(conf, 'local', 'overlap', 1)) * 3600
+
+    statement = local.insert().prefix_with('OR IGNORE')
+    columns = [central.c.date, central.c.time, central.c.badge, central.c.uscita, central.c.raw, central.c.inserted_at]
+    # The local store has no archive: the archived lines are copied inline
+    archived = 'raw_block' in central.c
+    if archived:
+        columns += [central.c.raw_block, central.c.raw_offset]
+    synced = 0
+    for badge in badges:
+        query = select(columns).where(central.c.badge == badge).order_by(central.c.date, central.c.time)
+        watermark = None if args.full else CLocal.execute(
+            text('SELECT inserted_at FROM sync_state WHERE badge = :badge'), dict(badge=badge)
+        ).scalar()
+        if watermark:
+            query = query.where(central.c.inserted_at >= text(
+                "CAST(:since AS timestamptz) - :overlap * interval '1 second'"
+            ).bindparams(since=watermark, overlap=overlap))
+            logging.debug(u"Syncing badge {} from the rows inserted since {}".format(badge, watermark))
+
+        latest = None
+        rows = CAbaita.execute(query.execution_options(stream_results=True), readonly=True)
+        for batch in batches(rows):
+            batch = [dict(row) for row in batch]
+            for row in batch:
+                inserted_at = row.pop('inserted_at')
+                latest = max(latest, inserted_at) if latest else inserted_at
+                if archived:
+                    block, offset = row.pop('raw_block'), row.pop('raw_offset')
+                    if row['raw'] is None and block is not None:
+                        row['raw'] = read_block(CAbaita, block)[offset]
+            with Metrics.span('insert'):
+                synced += CLocal.execute(statement, batch).rowcount
+        if latest:
+            CLocal.execute(text('INSERT OR REPLACE INTO sync_state (badge, inserted_at) VALUES (:badge, :inserted_at)'),
+                           dict(badge=badge, inserted_at=latest.isoformat()))
+    with Metrics.span('commit'):
+        CLocal.commit()
+    Metrics.count('rows_inserted', synced)
+
+    logging.info(u"Synced {} new rows of {}".format(synced, ', '.join(badges)))
+    print "Sincronizzate {} nuove timbrature".format(synced)
+
+
+def export_format(path, format=None):
+    """
+    Return the format and the path to export to: the format is guessed from the
+    extension if not given, and is CSV whenever pyarrow is missing.
+    """
+    root, extension = os.path.splitext(path)
+    format = format or export_extensions.get(extension, 'csv')
+    if format != 'csv':
+        try:
+            import pyarrow
+        except ImportError:
+            logging.warning(u"pyarrow is not installed, exporting to CSV")
+            print >> sys.stderr, "pyarrow non installato: esporto in CSV"
+            return 'csv', root + '.csv'
+    return format, path
+
+
+def export_rows(CTable, columns, badges=None, since=None, until=None, chunk_size=None):
+    """
+    Yield the rows of the table in lists of chunk_size dicts, read from a server-side cursor,
+    on a replica if any is configured.
+    """
+    from orm import iter_dicts
+
+    query = CTable.query(readonly=True).with_entities(*[getattr(CTable, name) for name in columns])
+    if badges:
+        query = query.filter(CTable.badge.in_(badges))
+    if since:
+        query = query.filter(CTable.date >= since)
+    if until:
+        query = query.filter(CTable.date <= until)
+    query = query.order_by(*[getattr(CTable, name) for name in columns if name in ('badge', 'date', 'time')])
+    return batches(Metrics.timed('export_query', iter_dicts(query, yield_per=chunk_size)), chunk_size)
+
+
+def summary_row(row):
+    return dict(
+        badge=row['badge'],
+        date=row['date'],
+        worked_minutes=int(row['worked'].total_seconds()) // 60 if row['worked'] is not None else None,
+        worked_maw_minutes=int(row['worked_maw'].total_seconds()) // 60 if row['worked_maw'] is not None else None,
+        punches=row['punches'],
+        anomaly=row['anomaly'],
+    )
+
+
+def write_export(path, format, schema, chunks):
+    """
+    Write the chunks of rows, dicts with the keys of schema, one at a time. Return the number of rows.
+    """
+    import csv
+
+    names = [name for name, kind in schema]
+    count = 0
+    if format == 'csv':
+        f = sys.stdout if path == '-' else gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb')
+        try:
+            writer = csv.DictWriter(f, names)
+            writer.writeheader()
+            for chunk in chunks:
+                with Metrics.span('export_write'):
+                    writer.writerows(chunk)
+                count += len(chunk)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        return count
+
+    import pyarrow
+    import pyarrow.parquet
+
+    types = dict(string=pyarrow.string(), date=pyarrow.date32(), time=pyarrow.time64('us'),
+                 int=pyarrow.int32(), bool=pyarrow.bool_())
+    schema = pyarrow.schema([pyarrow.field(name, types[kind]) for name, kind in schema])
+    sink = None
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
     else:
-        query = CAbaita.load(badge=badge).filter(CAbaita.date == datetime.date.today())
+        sink = pyarrow.OSFile(path, 'wb')
+        writer = pyarrow.RecordBatchFileWriter(sink, schema)
+    try:
+        for chunk in chunks:
+            with Metrics.span('export_write'):
+                arrays = [pyarrow.array([row[field.name] for row in chunk], type=field.type) for field in schema]
+                batch = pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+                if format == 'parquet':
+                    writer.write_table(pyarrow.Table.from_batches([batch]))
+                else:
+                    writer.write_batch(batch)
+            count += len(chunk)
+    finally:
+        writer.close()
+        if sink is not None:
+            sink.close()
+    return count
 
-    for date, rows in itertools.groupby(query, key=lambda r: r.date):
-        logging.debug(u"Printing report for day {}".format(date))
-        print_day(date, rows, maw=maw)
 
+def export(conf, args):
+    reject_local_summaries(args, args.summaries)
+    tables = get_local_tables(conf) if args.local else get_tables(conf, args)
+    format, path = export_format(args.output, args.format)
+    logging.info(u"Exporting {} of {} from {} to {} into {} as {}".format(
+        'summaries' if args.summaries else 'punches', args.badge or 'all the badges', args.since, args.until, path, format))
+
+    if args.summaries:
+        CSummary = get_summary(tables)
+        if CSummary is None:
+            sys.exit(1)
+        chunks = export_rows(CSummary, ['badge', 'date', 'worked', 'worked_maw', 'punches', 'anomaly'],
+                             args.badge, args.since, args.until, args.chunk_size)
+        chunks = ([summary_row(row) for row in chunk] for chunk in chunks)
+        schema = export_schemas['summaries']
+    else:
+        chunks = export_rows(get_punches(tables), ['badge', 'date', 'time', 'uscita'],
+                             args.badge, args.since, args.until, args.chunk_size)
+        schema = export_schemas['punches']
+
+    count = write_export(path, format, schema, chunks)
+    Metrics.count('rows_exported', count)
+    print >> sys.stderr, "Esportate {} righe in {}".format(count, path)
+
+
+def render_report(CAbaita, badge, date, maw=False, format='text'):
+    # From the primary: a lagging replica would put back in the cache the day a notification just dropped
+    days = report_days(CAbaita, badge, date, cached=False, readonly=False)
+    lines = []
+    for day, day_punches, worked, incomplete in days:
+        lines.extend(render_day(day, day_punches, maw=maw, worked=worked, incomplete=incomplete))
+    if not days:
+        lines = ["[{}]".format(date), "Nessuna timbratura", ""]
+    # The report of a single date: one day at most
+    punches = days[0][1] if days else []
+    if format == 'json':
+        return json.dumps(dict(
+            badge=badge,
+            date=str(date),
+            punches=[dict(time=str(t.time()), uscita=uscita) for t, uscita in sorted(punches)],
+            text=lines[:-1],
+        ))
+    return '\n'.join(lines)
+
+
+def serve(conf, args):
+    from orm import SessionPool
+    from service import CReportServer, listen
+    from storage import notify_channel
+
+    tables = get_local_tables(conf) if args.local else get_tables(conf, args)
+    CAbaita = get_punches(tables)
+    engine_name = CAbaita.__enginename__
+    engine = SessionPool.get_engine(engine_name)
+
+    address = args.bind or conf_get(conf, 'serve', 'bind', '127.0.0.1'), args.port or int(conf_get(conf, 'serve', 'port', 8080))
+    server = CReportServer(
+        address,
+        render=lambda badge, date, **kwargs: render_report(CAbaita, badge, date, **kwargs),
+        release=lambda: SessionPool.remove(engine_name),
+        maw=ast.literal_eval(conf.get('user', 'maw')),
+        ttl=float(conf_get(conf, 'serve', 'ttl', 3600)),
+    )
+
+    if engine.dialect.name == 'postgresql':
+        thread = threading.Thread(target=listen, args=(engine, notify_channel, server.cache))
+        thread.daemon = True
+        thread.start()
+    else:
+        # No notifications: the reports are only as fresh as the ttl
+        server.ttl = min(server.ttl, 60)
+
+    host, port = server.server_address
+    logging.info(u"[serve] Serving on {}:{}".format(host, port))
+    print "In ascolto su http://{}:{}/<badge>".format(host, port)
+    server.serve_forever()
+
+
+def load_checkpoint(key):
+    try:
+        with open(checkpoint_file) as f:
+            return json.load(f).get(key)
+    except (IOError, ValueError):
+        return None
+
+
+def save_checkpoint(key, checkpoint):
+    try:
+        with open(checkpoint_file) as f:
+            checkpoints = json.load(f)
+    except (IOError, ValueError):
+        checkpoints = {}
+    checkpoints[key] = checkpoint
+
+    # Write and rename, so that a crash never leaves a half written state file
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(checkpoints, f, indent=2, sort_keys=True)
+    os.rename(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def remote_stat(ftp, filename):
+    # SIZE and MDTM are optional extensions: without them we just download everything
+    ftp.voidcmd('TYPE I')
+    try:
+        size = ftp.size(filename)
+    except ftplib.all_errors:
+        size = None
+    try:
+        mtime = ftp.sendcmd('MDTM {}'.format(filename)).split()[-1]
+    except ftplib.all_errors:
+        mtime = None
+    return size, mtime
+
+
+def whitelist_hash(whitelist):
+    return hashlib.md5(' '.join(sorted(whitelist))).hexdigest()
+
+
+def resume_offset(checkpoint, size, mtime, database, whitelist):
+    """
+    Return the offset to restart the download from, None if there is nothing new.
+    The download restarts from guard_size bytes before the checkpoint, so that
+    we can check that the file has not been rotated in the meantime.
+    With another database or whitelist the rows before the checkpoint may be
+    missing: the download restarts from the beginning.
+    """
+    if not checkpoint or size is None or checkpoint['database'] != database:
+        return 0
+    if checkpoint.get('whitelist') != whitelist:
+        logging.info(u"The whitelist changed since the last scrape, downloading the whole file")
+        return 0
+    if size < checkpoint['offset']:
+        logging.warning(u"File truncated ({} < {}), downloading it again".format(size, checkpoint['offset']))
+        return 0
+    if size == checkpoint['offset'] and mtime == checkpoint['mtime']:
+        return None
+    return checkpoint['offset'] - min(guard_size, checkpoint['offset'])
+
+
+def new_checkpoint(position, size, mtime, database, whitelist):
+    return {
+        'offset': position['offset'],
+        'size': size,
+        'mtime': mtime,
+        'guard': hashlib.md5(position['tail']).hexdigest(),
+        'database': database,
+        'whitelist': whitelist,
+    }
 
-def scrape(conf, args):
-    database = args.database or conf.get('database', 'endpoint')
-    CAbaita = automap('abaita', database)['abaita']
 
-    user = args.user or conf.get('server', 'user')
-    address = args.address or conf.get('server', 'address')
-    password = args.password or conf.get('server', 'password')
-    filename = args.filename or conf.get('server', 'filename')
+class RotatedFile(Exception):
+    pass
 
+
+class SiteLate(Exception):
+    pass
+
+
+def iter_chunks(ftp, filename, rest=None, blocksize=8192):
+    # Same as ftp.retrbinary, but the chunks are pulled by the parser as they arrive
+    ftp.voidcmd('TYPE I')
+    conn = ftp.transfercmd('RETR {}'.format(filename), rest)
+    complete = False
+    try:
+        while True:
+            chunk = conn.recv(blocksize)
+            if not chunk:
+                complete = True
+                break
+            Metrics.count('bytes_downloaded', len(chunk))
+            yield chunk
+    finally:
+        conn.close()
+        # Read the reply even when the transfer is interrupted, or the control connection gets out of sync
+        try:
+            ftp.voidresp()
+        except ftplib.all_errors:
+            if complete:
+                raise
+
+
+def check_guard(chunks, position, checkpoint):
+    """
+    Strip the guard bytes from the head of the download, raising RotatedFile
+    if they do not match the ones recorded in the checkpoint.
+    """
+    length = checkpoint['offset'] - position['offset']
+    guard = ''
+    for chunk in chunks:
+        if len(guard) < length:
+            missing = length - len(guard)
+            guard, chunk = guard + chunk[:missing], chunk[missing:]
+            if len(guard) == length:
+                if hashlib.md5(guard).hexdigest() != checkpoint['guard']:
+                    raise RotatedFile()
+                position['offset'], position['tail'] = checkpoint['offset'], guard
+        if chunk:
+            yield chunk
+    if len(guard) < length:
+        raise RotatedFile()
+
+
+def iter_lines(chunks, position, complete=False):
+    """
+    Split the chunks into lines, yielding each one as soon as it is complete.
+    position['offset'] is moved past every complete line and position['tail']
+    keeps the last guard_size bytes before it, for the next checkpoint.
+    The last line may still be being written: without its newline it is not yielded,
+    and the offset stays before it so that it is read in full next time.
+    With complete, the chunks are a whole file that is not written any more: its last line is yielded.
+    """
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        end = pending.rfind('\n') + 1
+        if not end:
+            continue
+        position['offset'] += end
+        position['tail'] = (position['tail'] + pending[max(0, end - guard_size):end])[-guard_size:]
+        lines, pending = pending[:end - 1].split('\n'), pending[end:]
+        for line in lines:
+            yield line
+    if complete and pending:
+        yield pending
+
+
+def parse_rows(lines, whitelist, header=False):
+    """
+    Yield a (date, time, badge, uscita, raw) record for every whitelisted row.
+    """
+    parsed = filtered = malformed = 0
+    try:
+        for row in itertools.ifilter(None, itertools.imap(str.strip, lines)):
+            if header:
+                header = False
+                continue
+
+            try:
+                entry, badge, row_id, _ = row.split()
+                dt = datetime.datetime.strptime(row[9:23], "%Y%m%d%H%M%S")
+                uscita = bool(int(entry[-1]))
+            except ValueError:
+                logging.warning(u"Skipping malformed row {!r}".format(row))
+                malformed += 1
+                continue
+
+            badge = badge[:6]
+            if badge not in whitelist:
+                filtered += 1
+                continue
+
+            parsed += 1
+            yield dt.date(), dt.time(), badge, uscita, row
+    finally:
+        # Counted once at the end, not to pay for the lock on every row
+        Metrics.count('rows_parsed', parsed)
+        Metrics.count('rows_filtered', filtered)
+        Metrics.count('rows_malformed', malformed)
+
+
+def fetch(ftp, filename, whitelist, position, checkpoint):
+    """
+    Download the file from position['offset'], yielding the records as they are parsed.
+    """
+    download = iter_chunks(ftp, filename, rest=position['offset'] or None)
+    chunks = Metrics.timed('download', download)
+    if position['offset']:
+        chunks = check_guard(chunks, position, checkpoint)
+
+    try:
+        records = parse_rows(iter_lines(chunks, position), whitelist, header=not position['offset'])
+        for record in Metrics.timed('parse', records):
+            yield record
+    except RotatedFile:
+        download.close()
+        logging.warning(u"File rotated, downloading it again")
+        position.update(offset=0, tail='')
+        for record in fetch(ftp, filename, whitelist, position, None):
+            yield record
+
+
+def archive_enabled(conf):
+    return ast.literal_eval(conf_get(conf, 'database', 'archive_raw', 'False'))
+
+
+def migrate(conf, args):
+    from storage import migrate_table, supports_partitioning
+
+    CAbaita = get_abaita(conf, args)
+    table = CAbaita.__table__.name
+
+    if args.partition and not supports_partitioning(CAbaita):
+        version = '.'.join(map(str, CAbaita.connection().dialect.server_version_info))
+        logging.error(u"Partitioning needs PostgreSQL 11 or later, the server is {}".format(version))
+        sys.exit("Il partizionamento richiede PostgreSQL 11 o successivo, il server è il {}".format(version))
+    count = migrate_table(CAbaita, partition=args.partition, archive=args.archive_raw)
+    if args.archive_raw:
+        print "Archiviate {} righe: VACUUM FULL {} per recuperare lo spazio".format(count, table)
+    CAbaita.commit()
+    CAbaita.invalidate_cache()
+    logging.info(u"Migrated {}".format(table))
+
+
+def get_whitelist(conf, args):
     whitelist = args.badge
     if not whitelist:
         whitelist = set(filter(None, map(str.strip, conf.get('whitelist', 'values').split())))
+    return whitelist
+
+
+def get_sites(conf, args):
+    """
+    Site name -> FTP parameters, one site for [server] and one for every [server NAME] section.
+    Missing options but the address are taken from [server]; the command line overrides
+    them all, and an address on the command line selects just that server.
+    timeout is the number of seconds before a silent control or data connection fails,
+    deadline the seconds a scrape of the site may take before its records are committed without it.
+    """
+    sections = [s for s in conf.sections() if s == 'server' or s.startswith('server ')]
+    if args.address:
+        sections = ['server']
+
+    sites = {}
+    for section in sections:
+        site = dict(address=args.address or conf_get(conf, section, 'address'))
+        for option in ('user', 'password', 'filename'):
+            site[option] = getattr(args, option) or conf_get(conf, section, option) or conf_get(conf, 'server', option)
+        site['timeout'] = float(conf_get(conf, section, 'timeout') or conf_get(conf, 'server', 'timeout', 60))
+        site['deadline'] = float(conf_get(conf, section, 'deadline') or conf_get(conf, 'server', 'deadline', 600))
+        if site['address']:
+            sites[section] = site
+    return sites
 
-    logging.info(u"Scraping database. Whitelist: {}".format(whitelist))
 
-    # region Download the file
+def checkpoint_key(site):
+    return '{}/{}'.format(site['address'], site['filename'])
+
+
+def login(site):
+    with Metrics.span('ftp_login'):
+        # Also the timeout of the data connections: a half-open terminal must not hang the watch forever
+        ftp = ftplib.FTP(site['address'], timeout=site['timeout'])
+        ftp.login(site['user'], site['password'])
+    return ftp
+
+
+def download_site(name, site, whitelist, checkpoint, database_hash, connections, queue, late):
+    """
+    Thread body: download and parse the file of a site, putting the records on the queue
+    in batches. The last message of the site is ('done', checkpoint to save after the commit,
+    None if the file did not change or the server can not tell its size), or ('error', exit code).
+    Once the late event is set nobody reads the queue any more: the thread gives up.
+    """
+    def put(message):
+        while not late.is_set():
+            try:
+                queue.put(message, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        raise SiteLate()
+
+    stage = 1
+    ftp = None
     try:
-        ftp = ftplib.FTP(address)
-        ftp.login(user, password)
+        ftp = connections.pop(name, None)
+        if ftp is not None:
+            try:
+                # Keepalive, and the quickest way to find out that the server dropped us
+                ftp.voidcmd('NOOP')
+            except ftplib.all_errors:
+                ftp = None
+        if ftp is None:
+            ftp = login(site)
+            logging.debug(u"[{}] Login ok".format(name))
+        stage = 2
+
+        with Metrics.span('ftp_stat'):
+            size, mtime = remote_stat(ftp, site['filename'])
+        start = resume_offset(checkpoint, size, mtime, database_hash, whitelist_hash(whitelist))
+        if start is None:
+            logging.debug(u"[{}] Nothing new since the last scrape".format(name))
+            checkpoint = None
+        else:
+            position = {'offset': start, 'tail': ''}
+            for batch in batches(fetch(ftp, site['filename'], whitelist, position, checkpoint)):
+                put((name, 'records', batch))
+            logging.debug(u"[{}] Download ok: up to offset {}".format(name, position['offset']))
+            if size is not None:
+                checkpoint = new_checkpoint(position, size, mtime, database_hash, whitelist_hash(whitelist))
+            else:
+                checkpoint = None
+
+        connections[name] = ftp
+        try:
+            put((name, 'done', checkpoint))
+        except SiteLate:
+            connections.pop(name, None)
+            raise
+
+    except SiteLate:
+        logging.debug(u"[{}] Giving up, the scrape went on without this site".format(name))
+        if ftp is not None:
+            ftp.close()
     except Exception as e:
-        logging.exception(u"Could not login to the FTP server: {}".format(e))
-        sys.exit(1)
-    else:
-        logging.debug(u"Login ok")
+        if stage == 1:
+            logging.exception(u"[{}] Could not login to the FTP server: {}".format(name, e))
+        else:
+            logging.exception(u"[{}] Could not download the file from the FTP server: {}".format(name, e))
+        # Timed out or broken: the next poll logs in again
+        if ftp is not None:
+            ftp.close()
+        try:
+            put((name, 'error', stage))
+        except SiteLate:
+            pass
+
 
+def iter_queue(queue, deadlines, results, late):
+    """
+    Yield the records put on the queue by the download_site threads, storing their final
+    messages in results. deadlines is site name -> time by which the site must be done:
+    the sites that miss it are stored as failed, and their late event set.
+    """
+    while len(results) < len(deadlines):
+        pending = [name for name in deadlines if name not in results]
+        try:
+            name, kind, value = queue.get(timeout=max(0, min(deadlines[n] for n in pending) - time.time()))
+        except Queue.Empty:
+            for name in pending:
+                if deadlines[name] <= time.time():
+                    logging.error(u"[{}] Not done in time, committing the other sites without it".format(name))
+                    late[name].set()
+                    results[name] = 'error', 2
+            continue
+        if late[name].is_set():
+            continue
+        if kind == 'records':
+            for record in value:
+                yield record
+        else:
+            results[name] = kind, value
+
+
+def scrape_sites(sites, whitelist, checkpoints, database_hash, CAbaita, CSummary, connections, archive=False,
+                 save=True):
+    """
+    Scrape all the sites once: files are downloaded and parsed concurrently, one thread per
+    site, while the records are saved here as they arrive. A site that is not done by its
+    deadline fails, and the records of the others are committed anyway. After the commit, save the
+    checkpoints of the sites that went fine, in checkpoints and, with save, in the state file.
+    connections (site name -> FTP connection) is reused and updated for the next call.
+    archive moves the raw lines to the compressed archive, see ingest().
+    Return site name -> exit code for the sites that failed.
+    """
+    from storage import ingest
+
+    # Bounded, so that a slow database slows the downloads down instead of filling the memory
+    queue = Queue.Queue(maxsize=4 * len(sites))
+    late = dict((name, threading.Event()) for name in sites)
+    deadlines = dict((name, time.time() + site['deadline']) for name, site in sites.iteritems())
+    for name, site in sites.iteritems():
+        thread = threading.Thread(
+            target=download_site,
+            args=(name, site, whitelist, checkpoints[name], database_hash, connections, queue, late[name]),
+        )
+        thread.daemon = True
+        thread.start()
+
+    results = {}
+    records = iter_queue(queue, deadlines, results, late)
     try:
-        r = StringIO()
-        ftp.retrbinary('RETR {}'.format(filename), r.write)
-    except Exception as e:
-        logging.exception(u"Could not download the file from the FTP server: {}".format(e))
-        sys.exit(2)
+        inserted, skipped = ingest(CAbaita, batches(records), archive=archive)
+    except Exception:
+        # Let the downloads finish, or they would block forever on the full queue
+        for _ in records:
+            pass
+        raise
+    if inserted:
+        logging.info(u"Saving {} new rows to the database, {} were already there".format(len(inserted), skipped))
+        commit_punches(CAbaita, CSummary, inserted)
     else:
-        logging.debug(u"Download ok")
-    # endregion
+        logging.debug(u"No new rows, {} were already there".format(skipped))
+        # Nothing to commit: just do not leave the transaction open until the next poll
+        CAbaita.rollback()
+
+    errors = {}
+    for name, (kind, value) in results.iteritems():
+        if kind == 'error':
+            errors[name] = value
+        elif value is not None:
+            checkpoints[name] = value
+            if save:
+                save_checkpoint(checkpoint_key(sites[name]), value)
+    return errors
+
+
+def keep_alive(connections, seconds, interval):
+    """
+    Sleep for seconds, sending a NOOP on the idle FTP connections every interval seconds,
+    so that the servers do not drop them between one poll and the next.
+    The connections that fail are closed and dropped: the next poll logs in again.
+    """
+    wake_up = time.time() + seconds
+    while True:
+        time.sleep(max(0, min(interval, wake_up - time.time())))
+        if time.time() >= wake_up:
+            return
+        for name, ftp in connections.items():
+            try:
+                ftp.voidcmd('NOOP')
+            except ftplib.all_errors:
+                logging.debug(u"[{}] Connection dropped while idle".format(name))
+                del connections[name]
+                ftp.close()
+
+
+def commit_punches(CAbaita, CSummary, inserted):
+    from storage import notify_days
+
+    days = [(badge, date) for date, _, badge in inserted]
+    if CSummary is not None:
+        with Metrics.span('summaries'):
+            update_summaries(CAbaita, CSummary, days)
+    notify_days(CAbaita, days)
+    with Metrics.span('commit'):
+        CAbaita.commit()
+
+
+def scrape(conf, args):
+    from orm import SessionPool
+    from sqlalchemy.exc import SQLAlchemyError
+    from storage import partitions
+
+    database = args.database or conf.get('database', 'endpoint')
+    tables = get_tables(conf, args)
+    CAbaita, CSummary = get_punches(tables), get_summary(tables)
+
+    sites = get_sites(conf, args)
+    if not sites:
+        logging.error(u"No FTP server to scrape, see [server] address in .abaita.rc")
+        sys.exit(1)
+    whitelist = get_whitelist(conf, args)
+
+    logging.info(u"Scraping {}. Whitelist: {}".format(', '.join(sorted(sites)), whitelist))
 
-    rows = filter(None, map(str.strip, r.getvalue().split('\n')))
-    if not rows:
-        logging.warning(u"No rows found")
+    archive = archive_enabled(conf)
+    checkpoints = dict((name, None if args.full else load_checkpoint(checkpoint_key(site))) for name, site in sites.iteritems())
+    database_hash = hashlib.md5(database).hexdigest()
+    # A one-off whitelist on the command line must not move the checkpoints of the configured one
+    save = not args.badge
+    connections = {}
+    # Shorter than the idle timeout of the servers
+    keepalive = float(conf_get(conf, 'server', 'keepalive', 60))
+
+    if not args.watch:
+        errors = scrape_sites(sites, whitelist, checkpoints, database_hash, CAbaita, CSummary, connections, archive, save)
+        for ftp in connections.itervalues():
+            ftp.close()
+        if errors:
+            sys.exit(min(errors.itervalues()))
         return
 
-    data = {}
-    for row in rows[1:]:
-        time, badge, row_id, _ = row.split()
+    # Keep the FTP connections and the database session open between one poll and the next
+    while True:
+        try:
+            scrape_sites(sites, whitelist, checkpoints, database_hash, CAbaita, CSummary, connections, archive, save)
+            logging.debug(u"Connection pool: {}".format(SessionPool.pool_status('abaita')))
+            Metrics.flush()
+        except SQLAlchemyError as e:
+            logging.exception(u"Could not save the punches to the database: {}".format(e))
+            CAbaita.rollback()
+            # The partitions created in the transaction are gone too
+            partitions.clear()
+        keep_alive(connections, args.watch, keepalive)
 
-        badge = badge[:6]
-        if badge not in whitelist:
-            continue
 
-        dt = datetime.datetime.strptime(row[9:23], "%Y%m%d%H%M%S")
-        uscita = bool(int(time[-1]))
-        date = dt.date()
+def copy_escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
-        data[date, dt.time(), badge] = uscita, row
 
-    logging.debug(u"Found {} rows".format(len(data)))
+class CopyStream(object):
+    """
+    File-like object feeding the records to COPY FROM STDIN, in the text format.
+    """
 
-    # Avoid saving duplicate data to the database
-    existing_data = CAbaita.load().filter(CAbaita.badge.in_(whitelist))
-    for row in existing_data:
-        pk = (row.date, row.time, row.badge)
-        if pk in data:
-            del data[pk]
+    def __init__(self, records):
+        self.records = iter(records)
+        self.count = 0
+        self.buffer = ''
 
-    logging.info(u"Saving {} new rows to the database".format(len(data)))
-    for (date, dt, badge), (uscita, raw) in data.iteritems():
-        CAbaita(
-            date=date,
-            time=dt,
-            badge=badge,
-            uscita=uscita,
-            raw=raw,
-        ).save()
+    def read(self, size=-1):
+        lines, length = [self.buffer], len(self.buffer)
+        for date, punch_time, badge, uscita, raw in self.records:
+            line = '{}\t{}\t{}\t{}\t{}\n'.format(date, punch_time, copy_escape(badge), 't' if uscita else 'f', copy_escape(raw))
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+            if 0 <= size <= length:
+                break
+
+        data = ''.join(lines)
+        if size < 0:
+            size = len(data)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+
+def read_file(path, blocksize=65536):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), ''):
+            yield chunk
+
+
+def rebuild_summaries(conf, args):
+    tables = get_tables(conf, args)
+    CAbaita, CSummary = get_punches(tables), get_summary(tables)
+    if CSummary is None:
+        sys.exit(1)
+
+    query = punches_query(CAbaita)
+    if args.badge:
+        query = query.where(CAbaita.__table__.c.badge.in_(args.badge))
+
+    rows = CAbaita.execute(query.execution_options(stream_results=True))
+    count = save_summaries(CSummary, summarize(rows))
     CAbaita.commit()
+    logging.info(u"Rebuilt {} daily summaries".format(count))
+
+
+def load(conf, args):
+    from storage import copy_rows, notify_days
+
+    tables = get_tables(conf, args)
+    CAbaita, CSummary = get_punches(tables), get_summary(tables)
+
+    whitelist = get_whitelist(conf, args)
+    logging.info(u"Loading {}. Whitelist: {}".format(args.files, whitelist))
+
+    records = itertools.chain.from_iterable(
+        parse_rows(iter_lines(read_file(path), {'offset': 0, 'tail': ''}, complete=True), whitelist, header=True)
+        for path in args.files
+    )
+    stream = CopyStream(Metrics.timed('parse', records))
+    started = datetime.datetime.now()
+
+    # COPY into a staging table, then merge it letting the primary key drop the duplicates
+    days = copy_rows(CAbaita, stream, archive=archive_enabled(conf))
+    inserted = sum(count for badge, date, count in days)
+    Metrics.count('rows_inserted', inserted)
+    Metrics.count('rows_duplicate', stream.count - inserted)
+    if CSummary is not None:
+        with Metrics.span('summaries'):
+            update_summaries(CAbaita, CSummary, [(badge, date) for badge, date, count in days])
+    notify_days(CAbaita, [(badge, date) for badge, date, count in days])
+    with Metrics.span('commit'):
+        CAbaita.commit()
+    # The merge is plain SQL, the session can not tell that it wrote abaita
+    CAbaita.invalidate_cache()
+
+    elapsed = (datetime.datetime.now() - started).total_seconds()
+    logging.info(u"Loaded {} rows, {} new, in {}s".format(stream.count, inserted, elapsed))
+    print "Caricate {} righe ({} nuove) in {:.1f}s: {:.0f} righe/s".format(
+        stream.count, inserted, elapsed, stream.count / elapsed if elapsed else 0)
 
 
 if __name__ == '__main__':
@@ -210,11 +1438,56 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers()
     parser_scrape = subparsers.add_parser('scrape')
     parser_scrape.add_argument('-b', '--badge', type=str, nargs='+')
+    parser_scrape.add_argument('--full', action='store_true')
+    parser_scrape.add_argument('-w', '--watch', type=float, metavar='INTERVAL')
     parser_scrape.set_defaults(func=scrape)
 
+    parser_load = subparsers.add_parser('load')
+    parser_load.add_argument('files', nargs='+')
+    parser_load.add_argument('-b', '--badge', type=str, nargs='+')
+    parser_load.set_defaults(func=load)
+
+    parser_summarize = subparsers.add_parser('summarize')
+    parser_summarize.add_argument('-b', '--badge', type=str, nargs='+')
+    parser_summarize.set_defaults(func=rebuild_summaries)
+
+    parser_migrate = subparsers.add_parser('migrate')
+    parser_migrate.add_argument('--partition', action='store_true')
+    parser_migrate.add_argument('--archive-raw', action='store_true')
+    parser_migrate.set_defaults(func=migrate)
+
+    parser_export = subparsers.add_parser('export')
+    parser_export.add_argument('output', help='.parquet, .arrow, .csv, .csv.gz or - for CSV on stdout')
+    parser_export.add_argument('-b', '--badge', type=str, nargs='+')
+    parser_export.add_argument('--since', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date())
+    parser_export.add_argument('--until', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date())
+    parser_export.add_argument('-s', '--summaries', action='store_true')
+    parser_export.add_argument('-l', '--local', action='store_true')
+    parser_export.add_argument('--format', choices=['parquet', 'arrow', 'csv'])
+    parser_export.add_argument('--chunk-size', type=int, default=50 * batch_size)
+    parser_export.set_defaults(func=export)
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('--bind')
+    parser_serve.add_argument('--port', type=int)
+    parser_serve.add_argument('-l', '--local', action='store_true')
+    parser_serve.set_defaults(func=serve)
+
+    parser_sync = subparsers.add_parser('sync')
+    parser_sync.add_argument('-b', '--badge', type=str, nargs='+')
+    parser_sync.add_argument('--full', action='store_true')
+    parser_sync.set_defaults(func=sync)
+
     parser_print = subparsers.add_parser('print')
     parser_print.add_argument('badge', nargs='?')
     parser_print.add_argument('-a', '--all', action='store_true')
+    parser_print.add_argument('-s', '--summary', action='store_true')
+    parser_print.add_argument('-l', '--local', action='store_true')
+    parser_print.add_argument('-t', '--team', type=str, nargs='*', metavar='BADGE')
+    parser_print.add_argument('--since', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date())
+    parser_print.add_argument('--until', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date())
+    parser_print.add_argument('--csv', action='store_true')
+    parser_print.add_argument('-j', '--jobs', type=int)
     maw = parser_print.add_mutually_exclusive_group()
     maw.add_argument('-m', dest='mawify', action='store_true')
     maw.add_argument('-M', dest='mawify', action='store_false')
@@ -222,5 +1495,11 @@ if __name__ == '__main__':
     # endregion
 
     args = parser.parse_args(sys.argv[1:])
+    # Only now: SQLAlchemy and the log file are not needed for --help and the usage errors
+    configure_logging()
     logging.info(u"Starting abaita with arguments {}".format(args))
-    args.func(conf, args)
+    configure_metrics(conf, args)
+    try:
+        args.func(conf, args)
+    finally:
+        Metrics.flush()
@@ -56,12 +56,70 @@ CREATE TABLE abaita (
     "time" time without time zone NOT NULL,
     badge character varying NOT NULL,
     uscita boolean NOT NULL,
-    raw character varying
+    raw character varying,
+    raw_block integer,
+    raw_offset integer,
+    inserted_at timestamp with time zone DEFAULT now() NOT NULL
 );
 
 
 ALTER TABLE abaita OWNER TO $USER;
 
+--
+-- Name: abaita_raw; Type: TABLE; Schema: public; Owner: $USER; Tablespace: 
+--
+
+CREATE TABLE abaita_raw (
+    id integer NOT NULL,
+    data bytea NOT NULL
+);
+
+
+ALTER TABLE abaita_raw OWNER TO $USER;
+
+--
+-- Name: abaita_raw_id_seq; Type: SEQUENCE; Schema: public; Owner: $USER
+--
+
+CREATE SEQUENCE abaita_raw_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE abaita_raw_id_seq OWNER TO $USER;
+
+--
+-- Name: abaita_raw_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: $USER
+--
+
+ALTER SEQUENCE abaita_raw_id_seq OWNED BY abaita_raw.id;
+
+--
+-- Name: daily_summary; Type: TABLE; Schema: public; Owner: $USER; Tablespace: 
+--
+
+CREATE TABLE daily_summary (
+    badge character varying NOT NULL,
+    date date NOT NULL,
+    worked interval,
+    worked_maw interval,
+    punches integer NOT NULL,
+    anomaly boolean NOT NULL
+);
+
+
+ALTER TABLE daily_summary OWNER TO $USER;
+
+--
+-- Name: id; Type: DEFAULT; Schema: public; Owner: $USER
+--
+
+ALTER TABLE ONLY abaita_raw ALTER COLUMN id SET DEFAULT nextval('abaita_raw_id_seq'::regclass);
+
+
 --
 -- Name: abaita_pkey; Type: CONSTRAINT; Schema: public; Owner: $USER; Tablespace: 
 --
@@ -70,6 +128,29 @@ ALTER TABLE ONLY abaita
     ADD CONSTRAINT abaita_pkey PRIMARY KEY (date, "time", badge);
 
 
+--
+-- Name: abaita_raw_pkey; Type: CONSTRAINT; Schema: public; Owner: $USER; Tablespace: 
+--
+
+ALTER TABLE ONLY abaita_raw
+    ADD CONSTRAINT abaita_raw_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: daily_summary_pkey; Type: CONSTRAINT; Schema: public; Owner: $USER; Tablespace: 
+--
+
+ALTER TABLE ONLY daily_summary
+    ADD CONSTRAINT daily_summary_pkey PRIMARY KEY (badge, date);
+
+
+--
+-- Name: abaita_badge_date_time_idx; Type: INDEX; Schema: public; Owner: $USER; Tablespace: 
+--
+
+CREATE INDEX abaita_badge_date_time_idx ON abaita USING btree (badge, date, "time", uscita);
+
+
 --
 -- Name: public; Type: ACL; Schema: -; Owner: postgres
 --
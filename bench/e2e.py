@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End to end benchmark: generates a synthetic btransaction.loc, serves it over FTP
+(pyftpdlib, if installed) and times parsing, ingest, the rescan of the duplicates,
+the summaries and the report. Results go to a JSON file.
+Run it against a scratch database, its abaita and daily_summary tables are dropped:
+
+    python bench/e2e.py --badges 200 --days 250 --duplicates 0.05 --output e2e.json
+    python bench/e2e.py --database postgresql+psycopg2://localhost/scratch
+"""
+
+import argparse
+import datetime
+import imp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+abaita = imp.load_source('abaita_main', os.path.join(root, '__main__.py'))
+from orm import automap
+import storage
+
+tables = {
+    'abaita': """
+        CREATE TABLE abaita (
+            date date NOT NULL,
+            "time" time NOT NULL,
+            badge varchar NOT NULL,
+            uscita boolean NOT NULL,
+            raw varchar,
+            PRIMARY KEY (date, "time", badge)
+        )
+    """,
+    'daily_summary': """
+        CREATE TABLE daily_summary (
+            badge varchar NOT NULL,
+            date date NOT NULL,
+            worked interval,
+            worked_maw interval,
+            punches integer NOT NULL,
+            anomaly boolean NOT NULL,
+            PRIMARY KEY (badge, date)
+        )
+    """,
+}
+
+
+def generate(path, badges, days, duplicates, seed):
+    """
+    Write a transaction file in the format of the badge terminals: four punches a day
+    for every badge on working days, some missing, some sent twice.
+    Return the number of lines and the badges.
+    """
+    rand = random.Random(seed)
+    badges = ['{:06d}'.format(100000 + i) for i in range(badges)]
+    first = datetime.date.today() - datetime.timedelta(days=days - 1)
+    count = 0
+    with open(path, 'wb') as f:
+        f.write('TRANSAZIONI\r\n')
+        for day in (first + datetime.timedelta(days=n) for n in range(days)):
+            if day.isoweekday() > 5:
+                continue
+            punches = []
+            start = datetime.datetime.combine(day, datetime.time(8))
+            for badge in badges:
+                shifts = [0, 270, 315, 540]
+                if rand.random() < 0.02:
+                    del shifts[rand.randrange(4)]
+                for n, minutes in enumerate(shifts):
+                    dt = start + datetime.timedelta(minutes=minutes + rand.randint(-30, 30), seconds=rand.randint(0, 59))
+                    punches.append((dt, badge, n % 2))
+            for dt, badge, uscita in sorted(punches):
+                count += 1
+                line = '{:09d}{:%Y%m%d%H%M%S}{} {}000 {:06d} 00\r\n'.format(count, dt, uscita, badge, count % 1000000)
+                f.write(line)
+                if rand.random() < duplicates:
+                    f.write(line)
+                    count += 1
+    return count, badges
+
+
+class FileServer(object):
+    """
+    Serves a directory over FTP on a free local port, with pyftpdlib.
+    """
+
+    def __init__(self, directory):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import FTPServer
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('admin', 'admin', directory)
+        handler = type('Handler', (FTPHandler, object), dict(authorizer=authorizer))
+        self.server = FTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self):
+        import ftplib
+        ftp = ftplib.FTP()
+        ftp.connect(*self.server.address)
+        ftp.login('admin', 'admin')
+        return ftp
+
+    def close(self):
+        self.server.close_all()
+
+
+def sqlite_ingest(CAbaita, records):
+    # Stand-in for storage.ingest(), which needs PostgreSQL: its timings are marked in the results.
+    # No ON CONFLICT ... RETURNING here, count the inserted rows instead
+    statement = CAbaita.__table__.insert().prefix_with('OR IGNORE')
+    inserted, skipped = 0, 0
+    for batch in abaita.batches(records):
+        batch = [dict(date=date, time=time, badge=badge, uscita=uscita, raw=raw) for date, time, badge, uscita, raw in batch]
+        count = CAbaita.execute(statement, batch).rowcount
+        inserted += count
+        skipped += len(batch) - count
+    return inserted, skipped
+
+
+def render(CAbaita, badges):
+    """
+    Print the whole history of every badge, through report_days() and print_day() as print does.
+    """
+    days = 0
+    for badge in badges:
+        for date, punches, worked, incomplete in abaita.report_days(CAbaita, badge, cached=False):
+            abaita.print_day(date, punches, worked=worked, incomplete=incomplete)
+            days += 1
+    return days
+
+
+class Stages(object):
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, function, *args):
+        started = time.time()
+        result = function(*args)
+        elapsed = time.time() - started
+        rows = result[0] if isinstance(result, tuple) else len(result) if isinstance(result, list) else result
+        self.results[name] = dict(seconds=round(elapsed, 4), rows=rows,
+                                  rows_per_second=round(rows / elapsed, 1) if elapsed and rows else None)
+        print >> sys.stderr, '{:<10} {:>9.3f}s {:>10} righe'.format(name, elapsed, rows)
+        return result
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', help='SQLAlchemy URL, a temporary SQLite file by default')
+    parser.add_argument('--badges', type=int, default=100)
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--duplicates', type=float, default=0.05, help='ratio of the lines sent twice')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+    started = datetime.datetime.now()
+    abaita.configure_logging()
+
+    directory = tempfile.mkdtemp(prefix='abaita-bench-')
+    database = args.database or 'sqlite:///{}'.format(os.path.join(directory, 'abaita.db'))
+    engine = create_engine(database)
+    postgresql = engine.dialect.name == 'postgresql'
+    for name, ddl in sorted(tables.items()):
+        engine.execute('DROP TABLE IF EXISTS {}'.format(name))
+        if postgresql or name == 'abaita':
+            engine.execute(text(ddl))
+    engine.dispose()
+
+    mapped = automap('abaita', database, only=['abaita', 'daily_summary'])
+    CAbaita = abaita.get_punches(mapped)
+    CSummary = mapped['daily_summary'] if postgresql else None
+    stages = Stages()
+    try:
+        path = os.path.join(directory, 'btransaction.loc')
+        lines, badges = stages.run('generate', generate, path, args.badges, args.days, args.duplicates, args.seed)
+        whitelist = set(badges)
+
+        def parse():
+            position = {'offset': 0, 'tail': ''}
+            if server is None:
+                return list(abaita.parse_rows(abaita.iter_lines(abaita.read_file(path), position), whitelist, header=True))
+            ftp = server.connect()
+            try:
+                return list(abaita.fetch(ftp, 'btransaction.loc', whitelist, position, None))
+            finally:
+                ftp.close()
+
+        def ingest():
+            if postgresql:
+                inserted, skipped = storage.ingest(CAbaita, abaita.batches(records))
+                CAbaita.commit()
+                return len(inserted), skipped, inserted
+            inserted, skipped = sqlite_ingest(CAbaita, records)
+            CAbaita.commit()
+            return inserted, skipped, None
+
+        def summaries():
+            days = set((badge, date) for date, _, badge in inserted)
+            abaita.update_summaries(CAbaita, CSummary, days)
+            CAbaita.commit()
+            return len(days)
+
+        def report():
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                return render(CAbaita, badges)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+        try:
+            server = FileServer(directory)
+        except ImportError:
+            print >> sys.stderr, 'pyftpdlib non installato: il file viene letto dal disco'
+            server = None
+        try:
+            records = stages.run('parse', parse)
+        finally:
+            if server is not None:
+                server.close()
+
+        _, skipped, inserted = stages.run('ingest', ingest)
+        stages.results['ingest']['skipped'] = skipped
+        # Everything is there already: only the deduplication is left
+        _, skipped, _ = stages.run('rescan', ingest)
+        stages.results['rescan']['skipped'] = skipped
+        for name in ('ingest', 'rescan'):
+            stages.results[name]['function'] = 'ingest' if postgresql else 'sqlite_ingest'
+            stages.results[name]['production_path'] = postgresql
+        if not postgresql:
+            print >> sys.stderr, 'ingest e rescan: INSERT OR IGNORE su SQLite, non il percorso di produzione'
+        if CSummary is not None:
+            stages.run('summaries', summaries)
+        stages.run('report', report)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result = dict(
+        started=started.isoformat(),
+        revision=revision(),
+        database=engine.dialect.name,
+        ftp=server is not None,
+        parameters=dict(badges=args.badges, days=args.days, duplicates=args.duplicates, seed=args.seed, lines=lines),
+        stages=stages.results,
+    )
+    if args.output == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
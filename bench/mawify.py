@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Checks of mawify(): the punches of the last hour of the day roll over to the
+next day instead of failing, and mawify_many() (NumPy) gives the same results
+as mawify() on every minute of a day. Exits with 1 if a check fails.
+
+    python bench/mawify.py
+"""
+
+import datetime
+import imp
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+abaita = imp.load_source('abaita_main', os.path.join(root, '__main__.py'))
+
+day = datetime.datetime(2026, 12, 31)
+
+
+def check_rollover():
+    """
+    Every minute from 23:00, entry and exit: mawify() must not fail, and the
+    punches from 23:56 (and the entries from 23:35) must end at midnight.
+    """
+    failures = []
+    for minute in range(60):
+        for uscita in (False, True):
+            dt = day.replace(hour=23, minute=minute, second=42)
+            try:
+                result = abaita.mawify(dt, uscita)
+            except ValueError as e:
+                failures.append((dt, uscita, e))
+                continue
+            midnight = minute >= 56 or (not uscita and minute >= 35)
+            if (result == day + datetime.timedelta(days=1)) != midnight:
+                failures.append((dt, uscita, result))
+    return failures
+
+
+def check_parity():
+    """
+    Every minute of a day, entry and exit, on the minute, with seconds and with
+    microseconds: mawify_many() against mawify().
+    """
+    try:
+        import numpy
+    except ImportError:
+        print >> sys.stderr, 'numpy non installato: mawify_many() non controllato'
+        return []
+
+    punches = [
+        (day + datetime.timedelta(minutes=minute, seconds=seconds, microseconds=microseconds), uscita)
+        for minute in range(24 * 60)
+        for seconds, microseconds in [(0, 0), (42, 0), (59, 999999)]
+        for uscita in (False, True)
+    ]
+    expected = [abaita.mawify(*p) for p in punches]
+    times, uscite = zip(*punches)
+    results = [
+        abaita.mawify_many(times, uscite).tolist(),
+        # also from a datetime64 array, as read from the database
+        abaita.mawify_many(numpy.array(times, dtype='datetime64[us]'), uscite).tolist(),
+    ]
+    return [(p, e, r) for result in results for p, e, r in zip(punches, expected, result) if e != r]
+
+
+def main():
+    failed = False
+    for name, check in [('rollover', check_rollover), ('parity', check_parity)]:
+        failures = check()
+        print >> sys.stderr, '{:<10} {}'.format(name, 'ok' if not failures else '{} errori'.format(len(failures)))
+        for failure in failures[:10]:
+            print >> sys.stderr, '    {}'.format(failure)
+        failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Query plans of the badge queries on a synthetic abaita table, with the primary key
+only, with the (badge, date, time) index and partitioned by month.
+Run it against a scratch database: everything is created in the bench_plans schema.
+
+    python bench/plans.py postgresql+psycopg2://localhost/scratch --rows 3000000
+"""
+
+import argparse
+import datetime
+import re
+
+from sqlalchemy import create_engine, text
+
+schema = 'bench_plans'
+
+queries = [
+    ('today', """
+        SELECT date, "time", uscita FROM abaita
+        WHERE badge = :badge AND date = :last
+        ORDER BY "time"
+    """),
+    ('history', """
+        SELECT date, array_agg("time" ORDER BY "time"), count(*) < 4 FROM abaita
+        WHERE badge = :badge
+        GROUP BY date ORDER BY date
+    """),
+    ('summaries', """
+        SELECT badge, date, "time", uscita FROM abaita
+        WHERE (badge, date) IN ((:badge, :last), (:badge, :last - 1), (:other, :last))
+        ORDER BY badge, date, "time"
+    """),
+]
+
+
+def create_table(connection, partitioned, first, last):
+    connection.execute('DROP TABLE IF EXISTS abaita')
+    connection.execute("""
+        CREATE TABLE abaita (
+            date date NOT NULL,
+            "time" time without time zone NOT NULL,
+            badge character varying NOT NULL,
+            uscita boolean NOT NULL,
+            raw character varying
+        ) {}
+    """.format('PARTITION BY RANGE (date)' if partitioned else ''))
+    connection.execute('ALTER TABLE abaita ADD CONSTRAINT abaita_pkey PRIMARY KEY (date, "time", badge)')
+    if partitioned:
+        month = first.replace(day=1)
+        while month <= last:
+            following = (month + datetime.timedelta(days=32)).replace(day=1)
+            connection.execute("CREATE TABLE abaita_{0:%Y_%m} PARTITION OF abaita FOR VALUES FROM ('{0}') TO ('{1}')".format(
+                month, following))
+            month = following
+
+
+def fill_table(connection, first, last, badges):
+    # Four punches a day for every badge, in date order as the scraper would insert them
+    connection.execute(text("""
+        INSERT INTO abaita (date, "time", badge, uscita, raw)
+        SELECT d::date, t, lpad(b::text, 8, '0'), n % 2 = 0,
+               concat_ws(' ', to_char(d, 'DD/MM/YYYY'), t, lpad(b::text, 8, '0'), n % 2)
+        FROM generate_series(:first, :last, interval '1 day') d,
+             generate_series(1, 4) n,
+             generate_series(1, :badges) b,
+             LATERAL (SELECT time '06:00' + n * interval '2 hours 30 minutes' + (b % 60) * interval '1 minute' AS t) times
+    """), first=first, last=last, badges=badges)
+
+
+def explain(connection, query, params):
+    plan = [line for line, in connection.execute(text('EXPLAIN (ANALYZE, BUFFERS) ' + query), **params)]
+    elapsed = float(re.search(r'Execution [Tt]ime: ([\d.]+)', plan[-1]).group(1))
+    return plan, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database')
+    parser.add_argument('--rows', type=int, default=3000000)
+    parser.add_argument('--badges', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+
+    days = max(1, args.rows // (4 * args.badges))
+    last = datetime.date.today()
+    first = last - datetime.timedelta(days=days - 1)
+    params = dict(badge='{:08d}'.format(args.badges // 2), other='{:08d}'.format(1), last=last)
+
+    engine = create_engine(args.database)
+    connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    connection.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+    connection.execute('SET search_path = {}'.format(schema))
+
+    results = []
+    for variant, partitioned, index in (
+        ('pkey', False, False),
+        ('index', False, True),
+        ('partitioned', True, True),
+    ):
+        create_table(connection, partitioned, first, last)
+        fill_table(connection, first, last, args.badges)
+        if index:
+            connection.execute('CREATE INDEX abaita_badge_date_time_idx ON abaita (badge, date, "time", uscita)')
+        connection.execute('VACUUM ANALYZE abaita')
+        rows = connection.execute('SELECT count(*) FROM abaita').scalar()
+
+        for name, query in queries:
+            timings = []
+            for _ in range(args.repeat):
+                plan, elapsed = explain(connection, query, params)
+                timings.append(elapsed)
+            print '=== {} / {} ({} rows): best {:.2f} ms'.format(variant, name, rows, min(timings))
+            print '\n'.join(plan)
+            print
+            results.append((variant, name, min(timings)))
+
+    print '{:<12} {:<10} {:>10}'.format('variant', 'query', 'ms')
+    for variant, name, elapsed in results:
+        print '{:<12} {:<10} {:>10.2f}'.format(variant, name, elapsed)
+
+    if not args.keep:
+        connection.execute('DROP SCHEMA {} CASCADE'.format(schema))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup time of the command line: wall time of a few invocations, and where
+their imports spend it. Python 2 has no -X importtime, so the child process
+wraps __import__ and reports self and cumulative time of every module the same way.
+The commands that talk to the database, print included, still load SQLAlchemy and orm:
+only --help and the usage errors skip them.
+
+    python bench/startup.py --runs 20 --output startup.json
+    python bench/startup.py --command 'print -l' --command=--help
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+script = os.path.join(root, '__main__.py')
+
+commands = ['--help', 'print --help', 'scrape --bogus']
+
+profile = r"""
+import __builtin__, atexit, json, os, runpy, sys, time
+
+times, stack = {}, [0.0]
+original = __builtin__.__import__
+
+def module_name(name, globals_, fromlist):
+    # Python 2 tries the imports relative to the importing package first
+    globals_ = globals_ or {}
+    package = globals_.get('__name__', '')
+    if '__path__' not in globals_:
+        package = package.rpartition('.')[0]
+    if not name:
+        return '{}.{}'.format(package, ','.join(fromlist or ()))
+    if package and '{}.{}'.format(package, name) in sys.modules:
+        return '{}.{}'.format(package, name)
+    return name
+
+def timed_import(name, globals_=None, locals_=None, fromlist=None, level=-1):
+    before = len(sys.modules)
+    stack.append(0.0)
+    started = time.time()
+    try:
+        return original(name, globals_, locals_, fromlist, level)
+    finally:
+        elapsed = time.time() - started
+        nested = stack.pop()
+        stack[-1] += elapsed
+        if len(sys.modules) > before:
+            name = module_name(name, globals_, fromlist)
+            self_time, cumulative = times.get(name, (0.0, 0.0))
+            times[name] = (self_time + elapsed - nested, cumulative + elapsed)
+
+def dump(path=sys.argv[1]):
+    with open(path, 'w') as f:
+        json.dump(times, f)
+
+atexit.register(dump)
+__builtin__.__import__ = timed_import
+sys.argv = sys.argv[2:]
+# Where python __main__.py would look for metrics and orm
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    # A usage error is a result too: only a crash fails the profile
+    pass
+"""
+
+
+def run(argv, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.call([sys.executable, script] + argv, stdout=devnull, stderr=devnull)
+            timings.append((time.time() - started) * 1000)
+    timings.sort()
+    return dict(min_ms=round(timings[0], 2), median_ms=round(timings[len(timings) // 2], 2), runs=runs)
+
+
+def imports(argv, top):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            child = subprocess.Popen([sys.executable, '-c', profile, path, script] + argv, cwd=root,
+                                     stdout=devnull, stderr=subprocess.PIPE)
+            _, errors = child.communicate()
+        if child.returncode:
+            raise RuntimeError('Profiling {} failed:\n{}'.format(' '.join(argv), errors))
+        with open(path) as f:
+            times = json.load(f)
+    finally:
+        os.remove(path)
+    slowest = sorted(times.iteritems(), key=lambda item: -item[1][1])[:top]
+    return [dict(module=name, self_ms=round(self_time * 1000, 2), cumulative_ms=round(cumulative * 1000, 2))
+            for name, (self_time, cumulative) in slowest]
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--command', action='append',
+                        help='arguments of __main__.py, repeatable; --command=--help if they start with -')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to report')
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    results = {}
+    for command in args.command or commands:
+        argv = shlex.split(command)
+        results[command] = run(argv, args.runs)
+        results[command]['imports'] = imports(argv, args.top)
+        print >> sys.stderr, '{:<20} {:>8.1f} ms'.format(command, results[command]['median_ms'])
+
+    result = dict(
+        started=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        revision=revision(),
+        python=sys.version.split()[0],
+        commands=results,
+    )
+    if args.output == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
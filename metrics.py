@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import os
+import threading
+import time
+from logging import getLogger
+
+__all__ = ['CMetrics', 'Metrics']
+
+
+class CMetrics(object):
+    """
+    Timing spans and counters of one run, written to a file at the end as a
+    JSON line (appended) or in the Prometheus text format (replaced, for the
+    textfile collector of node_exporter).
+    Spans with the same name and labels are added up. Time spent in a nested
+    span or timed iterator is not counted in the outer one, so that parsing
+    does not include the download it is pulling the data from.
+    """
+
+    formats = ('json', 'prometheus')
+
+    def __init__(self):
+        self.path = None
+        self.format = 'json'
+        self.labels = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def configure(self, path, format='json', **labels):
+        """
+        @param path: file to write to, None to disable the export
+        @param format: 'json' or 'prometheus'
+        @param labels: added to every span and counter, e.g. the command
+        """
+        if format not in self.formats:
+            raise ValueError(u"Unknown metrics format {!r}, expected one of {}".format(format, self.formats))
+        self.path = path
+        self.format = format
+        self.labels = labels
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def record(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            total, count = self.spans.get(key, (0.0, 0))
+            self.spans[key] = (total + seconds, count + 1)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        outer, self._local.nested = getattr(self._local, 'nested', 0.0), 0.0
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.record(name, elapsed - self._local.nested, **labels)
+            self._local.nested = outer + elapsed
+
+    def timed(self, name, iterable, **labels):
+        """
+        Iterate over iterable, recording the time spent producing the items as one span.
+        """
+        iterator = iter(iterable)
+        total = 0.0
+        try:
+            while True:
+                outer, self._local.nested = getattr(self._local, 'nested', 0.0), 0.0
+                started = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.time() - started
+                    total += elapsed - self._local.nested
+                    self._local.nested = outer + elapsed
+                yield item
+        finally:
+            self.record(name, total, **labels)
+
+    def flush(self):
+        """
+        Write the metrics collected since the last reset, then reset them.
+        """
+        if self.path:
+            try:
+                if self.format == 'json':
+                    self._write_json()
+                else:
+                    self._write_prometheus()
+            except (IOError, OSError) as e:
+                getLogger(__name__).warning(u"Could not write the metrics to {}: {}".format(self.path, e))
+        self.reset()
+
+    def _items(self):
+        with self._lock:
+            spans = sorted(self.spans.iteritems())
+            counters = sorted(self.counters.iteritems())
+        return spans, counters
+
+    def _write_json(self):
+        spans, counters = self._items()
+        line = dict(
+            timestamp=self.started,
+            duration=time.time() - self.started,
+            labels=self.labels,
+            spans=[dict(name=name, labels=dict(labels), seconds=round(seconds, 6), count=count)
+                   for (name, labels), (seconds, count) in spans],
+            counters=[dict(name=name, labels=dict(labels), value=value) for (name, labels), value in counters],
+        )
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def _write_prometheus(self):
+        spans, counters = self._items()
+        lines = [
+            '# HELP abaita_stage_seconds Time spent in each stage by the last run.',
+            '# TYPE abaita_stage_seconds gauge',
+        ]
+        for (name, labels), (seconds, count) in spans:
+            lines.append('abaita_stage_seconds{} {:.6f}'.format(self._labels(labels, stage=name), seconds))
+        for name in sorted(set(name for (name, _), _ in counters)):
+            lines.append('# TYPE abaita_{} gauge'.format(name))
+            for (counter, labels), value in counters:
+                if counter == name:
+                    lines.append('abaita_{}{} {}'.format(name, self._labels(labels), value))
+        lines.append('# TYPE abaita_last_run_timestamp_seconds gauge')
+        lines.append('abaita_last_run_timestamp_seconds{} {:.3f}'.format(self._labels(()), self.started))
+        lines.append('# TYPE abaita_last_run_duration_seconds gauge')
+        lines.append('abaita_last_run_duration_seconds{} {:.6f}'.format(self._labels(()), time.time() - self.started))
+
+        # the collector must never read a half-written file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(self.path + '.tmp', self.path)
+
+    def _labels(self, labels, **extra):
+        labels = dict(self.labels, **dict(labels, **extra))
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in sorted(labels.iteritems())) + '}'
+
+
+Metrics = CMetrics()
+
+
+if __name__ == '__main__':
+    pass
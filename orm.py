@@ -7,17 +7,28 @@ extended with SQLAlchemy database reflection.
 """
 
 
+import os
 import sys
+import datetime
+import time
+import hashlib
+import threading
+import itertools
 import collections
+import cPickle as pickle
 from logging import getLogger
-from sqlalchemy import create_engine
+import sqlalchemy
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import MetaData, or_, and_
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import MetaData, event, or_, and_, tuple_
+from sqlalchemy.exc import InvalidRequestError, SQLAlchemyError
 from sqlalchemy.ext.automap import automap_base, generate_relationship
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import Query, interfaces
-from sqlalchemy.util import KeyedTuple
 
 
 __author__ = 'fgiuba'
@@ -25,13 +36,45 @@ __email__ = 'federico.giuba@copangroup.com'
 __all__ = [
     'automap',
     'CScopedSessionPool',
+    'CTimedQueuePool',
+    'CQueryCache',
+    'CMemoryCacheStore',
+    'CFileCacheStore',
     'CAutomappingActiveDomainObject',
     'CAutomappingMetaClass',
     'CAutomappingBase',
+    'CAutomappedTables',
     'to_list_of_dict',
+    'to_iter_of_dict',
+    'iter_dicts',
 ]
 
 
+class CTimedQueuePool(QueuePool):
+    """
+    QueuePool that keeps track of how long checkouts wait for a connection,
+    including the time spent opening new ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CTimedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(CTimedQueuePool, self)._do_get()
+        finally:
+            elapsed = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+
+
 class CScopedSessionPool(object):
     """
     Manages the session pool and related engines and sessionmakers.
@@ -43,6 +86,8 @@ class CScopedSessionPool(object):
     _default_engine = None
     engines = dict()
     _sessionmakers = dict()
+    _replicas = dict()
+    _replica_counters = dict()
 
     def new_engine(self, engine_name, url, set_as_default=False, **kwargs):
         """
@@ -50,11 +95,15 @@ class CScopedSessionPool(object):
         :param engine_name: identifier of the new engine
         :param url: URL of the databate
         :param set_as_default: if True, set the engine as default
-        :param kwargs: kwargs for create_engine()
+        :param kwargs: kwargs for create_engine(), i.e. pool_size, max_overflow,
+                       pool_timeout, pool_recycle, pool_pre_ping, plus statement_timeout
+                       (milliseconds, PostgreSQL only) and replicas (URLs of read-only
+                       replicas of the database, created with the same kwargs)
         """
-        echo = kwargs.pop('echo', True)
-        engine = create_engine(url, echo=echo, **kwargs)
-        self.add_engine(engine_name, engine, set_as_default)
+        replicas = kwargs.pop('replicas', None) or []
+        self.add_engine(engine_name, self._create_engine(url, dict(kwargs)), set_as_default)
+        for replica_url in replicas:
+            self.add_replica(engine_name, self._create_engine(replica_url, dict(kwargs)))
 
     def add_engine(self, engine_name, engine, set_as_default=False):
         """
@@ -68,10 +117,50 @@ class CScopedSessionPool(object):
         self.engines[engine_name] = engine
         if not self._default_engine or set_as_default:
             self._default_engine = engine_name
-        self._sessionmakers[engine_name] = scoped_session(sessionmaker(
+        factory = sessionmaker(
             bind=engine,
             autoflush=False,
-        ))
+        )
+        event.listen(factory, 'before_flush', _record_written)
+        self._sessionmakers[engine_name] = scoped_session(factory)
+        self._replicas[engine_name] = []
+        self._replica_counters[engine_name] = itertools.count()
+
+    def add_replica(self, engine_name, engine):
+        """
+        Adds a read-only replica to an engine already in the session pool.
+        Read-only sessions of the engine are spread over its replicas round-robin:
+        they are in autocommit mode, so that no transaction stays open on the replica.
+        :param engine_name: identifier of the primary engine
+        :param engine: engine of the replica
+        """
+        self._check_engine(engine_name)
+        self._replicas[engine_name].append(scoped_session(sessionmaker(
+            bind=engine,
+            autoflush=False,
+            autocommit=True,
+        )))
+
+    @staticmethod
+    def _create_engine(url, kwargs):
+        """
+        Return a new engine, see new_engine() for kwargs.
+        """
+        echo = kwargs.pop('echo', True)
+        backend = make_url(url).get_backend_name()
+
+        statement_timeout = kwargs.pop('statement_timeout', None)
+        if statement_timeout is not None:
+            if backend != 'postgresql':
+                raise Exception(u"statement_timeout is supported only by PostgreSQL")
+            connect_args = kwargs.setdefault('connect_args', {})
+            connect_args['options'] = '-c statement_timeout={:d}'.format(statement_timeout)
+
+        # SQLite has its own pool classes
+        if backend != 'sqlite':
+            kwargs.setdefault('poolclass', CTimedQueuePool)
+
+        return create_engine(url, echo=echo, **kwargs)
 
     def get_engine(self, engine_name):
         """
@@ -83,6 +172,30 @@ class CScopedSessionPool(object):
         self._check_engine(engine_name)
         return self.engines[engine_name]
 
+    def pool_status(self, engine_name):
+        """
+        Return the statistics of the connection pool of the engine.
+        Waits are tracked only by CTimedQueuePool, the default for new_engine().
+        :param engine_name: engine identifier
+        :return: size, checked_in, checked_out, overflow, checkouts, wait_time, max_wait
+        :rtype: dict
+        """
+        pool = self.get_engine(engine_name).pool
+        status = dict.fromkeys(('size', 'checked_in', 'checked_out', 'overflow'))
+        if isinstance(pool, QueuePool):
+            status.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+            )
+        status.update(
+            checkouts=getattr(pool, 'checkouts', None),
+            wait_time=getattr(pool, 'wait_time', None),
+            max_wait=getattr(pool, 'max_wait', None),
+        )
+        return status
+
     def set_default_engine(self, engine_name):
         """
         Set an engine as default.
@@ -99,10 +212,11 @@ class CScopedSessionPool(object):
         """
         return self._default_engine
 
-    def get_session(self, engine_name=None):
+    def get_session(self, engine_name=None, readonly=False):
         """
         Return the session associated to the engine.
         :param engine_name: engine identifier
+        :param readonly: if True and the engine has replicas, return the session of the next replica
         :return: scoped session
         :rtype: sqlalchemy.orm.session.Session
         """
@@ -110,6 +224,9 @@ class CScopedSessionPool(object):
             self._check_default_engine()
             engine_name = self._default_engine
         self._check_engine(engine_name)
+        replicas = self._replicas[engine_name]
+        if readonly and replicas:
+            return replicas[next(self._replica_counters[engine_name]) % len(replicas)]()
         session = self._sessionmakers[engine_name]()
         return session
 
@@ -137,11 +254,13 @@ class CScopedSessionPool(object):
             session.commit()
         except SQLAlchemyError:
             exc_type, exc_value, exc_traceback = sys.exc_info()
+            _written_tables(session)
             try:
                 session.rollback()
             except SQLAlchemyError:
                 pass
             raise exc_type, exc_value, exc_traceback
+        QueryCache.invalidate(_written_tables(session))
 
     def flush(self, engine_name):
         """
@@ -162,6 +281,17 @@ class CScopedSessionPool(object):
             exc_type, exc_value, exc_traceback = sys.exc_info()
             raise exc_type, exc_value, exc_traceback
 
+    def remove(self, engine_name):
+        """
+        Close the sessions of the current thread on the engine and on its replicas,
+        giving their connections back to the pool: needed by short-lived threads.
+        :param engine_name: engine identifier
+        """
+        self._check_engine(engine_name)
+        self._sessionmakers[engine_name].remove()
+        for replica in self._replicas[engine_name]:
+            replica.remove()
+
     def _check_engine(self, engine_name):
         """
         Check if engine_name exists.
@@ -181,12 +311,193 @@ class CScopedSessionPool(object):
 SessionPool = CScopedSessionPool()
 
 
+class CMemoryCacheStore(object):
+    """
+    In-process store for CQueryCache: LRU with a time to live.
+    """
+
+    def __init__(self, max_entries=256, ttl=300):
+        """
+        @param max_entries: entries kept, the least recently used are evicted first
+        @param ttl: seconds before an entry expires
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, table_name, key):
+        with self._lock:
+            entry = self._entries.pop((table_name, key), None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._entries[table_name, key] = entry
+            return entry[1]
+
+    def set(self, table_name, key, value):
+        with self._lock:
+            self._entries.pop((table_name, key), None)
+            self._entries[table_name, key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table_name):
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0] == table_name]:
+                del self._entries[entry_key]
+
+
+class CFileCacheStore(object):
+    """
+    Store for CQueryCache shared by all the processes using the same directory:
+    one pickle per entry in a subdirectory per table. LRU with a time to live,
+    the modification time of the file being the last use.
+    """
+
+    def __init__(self, directory, max_entries=1024, ttl=300):
+        """
+        @param directory: cache directory, created if necessary
+        @param max_entries: entries kept, the least recently used are evicted first
+        @param ttl: seconds before an entry expires
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, table_name, key):
+        path = os.path.join(self.directory, table_name, '{}.pickle'.format(key))
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+            if expires < time.time():
+                os.remove(path)
+                return None
+            os.utime(path, None)
+            return value
+        except Exception:
+            # missing, just invalidated or corrupted
+            return None
+
+    def set(self, table_name, key, value):
+        directory = os.path.join(self.directory, table_name)
+        path = os.path.join(directory, '{}.pickle'.format(key))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump((time.time() + self.ttl, value), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+            self._evict()
+        except (IOError, OSError) as e:
+            getLogger(__name__).warning(u"Could not cache the query result: {}".format(e))
+
+    def invalidate(self, table_name):
+        directory = os.path.join(self.directory, table_name)
+        for name in self._listdir(directory):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _evict(self):
+        entries = []
+        for table_name in self._listdir(self.directory):
+            directory = os.path.join(self.directory, table_name)
+            for name in self._listdir(directory):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(directory, name)), os.path.join(directory, name)))
+                except OSError:
+                    pass
+        if len(entries) > self.max_entries:
+            for mtime, path in sorted(entries)[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _listdir(directory):
+        try:
+            return os.listdir(directory)
+        except OSError:
+            return []
+
+
+class CQueryCache(object):
+    """
+    Result cache of CAutomappingActiveDomainObject.load_cached() and execute_cached().
+    Entries are keyed by engine, table and normalized query, and are invalidated
+    table by table when a commit writes to it. Disabled until a store is set:
+    CMemoryCacheStore or, to share it between processes, CFileCacheStore.
+    """
+
+    store = None
+
+    def set_store(self, store):
+        """
+        Set the store of the cache, None to disable it.
+        @param store: CMemoryCacheStore, CFileCacheStore or None
+        """
+        self.store = store
+
+    @staticmethod
+    def key(*parts):
+        """
+        Return the cache key of the query identified by parts.
+        """
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get(self, table_name, key):
+        return self.store.get(table_name, key) if self.store is not None else None
+
+    def set(self, table_name, key, value):
+        if self.store is not None:
+            self.store.set(table_name, key, value)
+
+    def invalidate(self, table_names):
+        """
+        Drop the entries of the given tables.
+        @param table_names: iterable of table names
+        """
+        if self.store is not None:
+            for table_name in table_names:
+                self.store.invalidate(table_name)
+
+
+QueryCache = CQueryCache()
+
+
+def _written_tables(session):
+    """
+    Return and forget the names of the tables the session wrote since the last commit:
+    the ones of the instances flushed and the ones marked by bulk and Core statements.
+    @param session: session just committed or rolled back
+    @rtype: set
+    """
+    return session.info.pop('written_tables', set())
+
+
+def _mark_written(session, table_name):
+    session.info.setdefault('written_tables', set()).add(table_name)
+
+
+def _record_written(session, flush_context, instances):
+    """
+    before_flush listener: remember the tables of the instances about to be flushed,
+    also when the flush happens before and apart from the commit.
+    """
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        _mark_written(session, instance.__table__.name)
+
+
 class CAutomappingActiveDomainObject(object):
     """
     Represents a mapped table and manages interactions with DB
     """
 
     __enginename__ = None
+    __batchsize__ = 1000
     _logger = getLogger('RastServer')  # TODO: fix logging
 
     @classmethod
@@ -194,13 +505,39 @@ class CAutomappingActiveDomainObject(object):
         """
         Performs a simple query retrieving the session from the specified session pool.
         @param entities: other tables to query (CAutomappingActiveDomainObject)
-        @param kwargs: passed to query()
+        @param kwargs: passed to query(), but readonly: if True, the query may run on a read-only replica
         @return: resulting Query object or None if the query result is empty
         @rtype: sqlalchemy.orm.query.Query or None
         """
-        session = cls._get_session()
+        session = cls._get_session(readonly=kwargs.pop('readonly', False))
         return session.query(cls, *entities, **kwargs)
 
+    @classmethod
+    def execute(cls, statement, params=None, readonly=False):
+        """
+        Executes a Core statement (i.e. insert(cls.__table__)) in the session of the class.
+        @param statement: statement to execute
+        @param params: bind parameters of the statement
+        @param readonly: if True, the statement may run on a read-only replica
+        @return: result of the execution
+        @rtype: sqlalchemy.engine.ResultProxy
+        """
+        session = cls._get_session(readonly=readonly)
+        if isinstance(statement, UpdateBase):
+            _mark_written(session, statement.table.name)
+        return session.execute(statement, params)
+
+    @classmethod
+    def connection(cls):
+        """
+        Return the connection of the current transaction in the session of the class.
+        Its .connection attribute is the DBAPI connection, i.e. to use COPY with psycopg2.
+        @return: connection
+        @rtype: sqlalchemy.engine.Connection
+        """
+        session = cls._get_session()
+        return session.connection()
+
     @classmethod
     def load(cls, **kwargs):
         """
@@ -208,11 +545,14 @@ class CAutomappingActiveDomainObject(object):
         Uses Query.filter_by() method.
         kwargs must be like: attribute_name='value'
         Conditions are combined with AND operator.
-        @param kwargs: condition on attributes
+        With readonly=True the query may run on a read-only replica, as for load_and(),
+        load_or() and first(): the instances are then bound to a session that never
+        commits, so do not modify them.
+        @param kwargs: condition on attributes, and readonly
         @return: filtered Query object
         @rtype: sqlalchemy.orm.query.Query
         """
-        session = cls._get_session()
+        session = cls._get_session(readonly=kwargs.pop('readonly', False))
         return session.query(cls).filter_by(**kwargs)
 
     @classmethod
@@ -222,11 +562,11 @@ class CAutomappingActiveDomainObject(object):
         Implements and_() method.
         kwargs must belike: attribute_name='value'
         Conditions are combined with AND operator.
-        @param kwargs: condition on attributes
+        @param kwargs: condition on attributes, and readonly (see load())
         @return: filtered Query object
         @rtype: sqlalchemy.orm.query.Query
         """
-        session = cls._get_session()
+        session = cls._get_session(readonly=kwargs.pop('readonly', False))
         conditions = []
         for (column_name, values) in kwargs.iteritems():
             column = getattr(cls, column_name)
@@ -243,11 +583,11 @@ class CAutomappingActiveDomainObject(object):
         Implements or_() method.
         kwargs must be like: attribute_name='value'
         Conditions are combined with OR operator.
-        @param kwargs: condition on attributes
+        @param kwargs: condition on attributes, and readonly (see load())
         @return: filtered Query object
         @rtype: sqlalchemy.orm.query.Query
         """
-        session = cls._get_session()
+        session = cls._get_session(readonly=kwargs.pop('readonly', False))
         conditions = []
         for (column_name, values) in kwargs.iteritems():
             column = getattr(cls, column_name)
@@ -257,6 +597,70 @@ class CAutomappingActiveDomainObject(object):
         instances = session.query(cls).filter(or_(*conditions))
         return instances
 
+    @classmethod
+    def load_cached(cls, **kwargs):
+        """
+        Return load(**kwargs).all(), through QueryCache if it has a store.
+        The instances are transient copies rebuilt from the cached columns:
+        use them read-only.
+        @param kwargs: condition on attributes
+        @return: instances
+        @rtype: list
+        """
+        table_name = cls.__table__.name
+        key = QueryCache.key(cls._engine_url(), table_name, sorted(kwargs.iteritems()))
+        cached = QueryCache.get(table_name, key)
+        if cached is None:
+            if QueryCache.store is None:
+                return cls.load(**kwargs).all()
+            columns = [column.name for column in cls.__table__.columns]
+            query = cls.load(readonly=True, **kwargs).with_entities(*[getattr(cls, column) for column in columns])
+            cached = columns, [tuple(row) for row in query]
+            QueryCache.set(table_name, key, cached)
+        columns, rows = cached
+        return [cls(**dict(zip(columns, row))) for row in rows]
+
+    @classmethod
+    def execute_cached(cls, statement, params=None, readonly=True):
+        """
+        Return the rows of a Core SELECT as a list of named tuples,
+        through QueryCache if it has a store (without one, as the list of RowProxy
+        of execute(), which have the same attributes).
+        @param statement: SELECT statement
+        @param params: bind parameters of the statement
+        @param readonly: if True, the statement may run on a read-only replica
+        @return: rows
+        @rtype: list
+        """
+        if QueryCache.store is None:
+            # not to compile and hash the statement for nothing
+            return cls.execute(statement, params, readonly=readonly).fetchall()
+        compiled = statement.compile(dialect=SessionPool.get_engine(cls._engine_name()).dialect)
+        tables = sorted(set(t.name for t in find_tables(statement)))
+        key = QueryCache.key(cls._engine_url(), unicode(compiled), sorted(compiled.params.iteritems()), params)
+        # a write to any of the tables drops its copy: a miss under one of them is a miss
+        cached = None
+        for table_name in tables:
+            cached = QueryCache.get(table_name, key)
+            if cached is None:
+                break
+        if cached is None:
+            result = cls.execute(statement, params, readonly=readonly)
+            cached = list(result.keys()), [tuple(row) for row in result]
+            # stored under every table, so that a write to any of them drops it
+            for table_name in tables:
+                QueryCache.set(table_name, key, cached)
+        keys, rows = cached
+        Row = collections.namedtuple('Row', keys, rename=True)
+        return [Row(*row) for row in rows]
+
+    @classmethod
+    def invalidate_cache(cls):
+        """
+        Drop the QueryCache entries of the table, i.e. after writing it with plain SQL.
+        """
+        QueryCache.invalidate([cls.__table__.name])
+
     @classmethod
     def load_pk(cls, key):
         """
@@ -280,7 +684,7 @@ class CAutomappingActiveDomainObject(object):
         """
         Return the first query result.
         Conditions on attributes can be passed with kwargs.
-        @param kwargs: condition on attributes
+        @param kwargs: condition on attributes, and readonly (see load())
         @return: instance as result of the query
         """
         return cls.load(**kwargs).first()
@@ -291,10 +695,11 @@ class CAutomappingActiveDomainObject(object):
         Return the query result cardinality.
         Conditions on attributes can be passed with kwargs.
         @param kwargs: condition on attributes
+        If the engine has replicas the query runs on one of them.
         @return: number of tuples in query result
         @rtype: int
         """
-        return cls.load(**kwargs).count()
+        return cls.load(readonly=True, **kwargs).count()
 
     def save(self):
         """
@@ -315,24 +720,35 @@ class CAutomappingActiveDomainObject(object):
         session.add(cls(**kwargs))
 
     @classmethod
-    def save_all(cls, items):
+    def save_all(cls, items, batch_size=None):
         """
         Places items in the Session.
-        Their states will be persisted to the database on the next flush operation.
-        Repeated calls to add() will be ignored.
-        Items can be both dict or CAutomappingActiveDomainObject
+        Items can be both dict or CAutomappingActiveDomainObject.
+        Instances will be persisted to the database on the next flush operation;
+        dicts are inserted right away, batch_size at a time, with bulk_insert_mappings()
+        (executemany): they bypass the unit of work, so no instance is added to the Session.
+        The Session is flushed before each batch of dicts, so that they can reference the
+        instances passed before them.
         @param items: list of instances to be added
+        @param batch_size: dicts per INSERT, defaults to __batchsize__
         """
         if not isinstance(items, collections.Iterable):
             items = [items, ]
-        for item in items:
-            if isinstance(item, dict):
-                cls.save_by(**item)
-            elif isinstance(item, cls):
-                item.save()
-            else:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                raise exc_type, exc_value, exc_traceback
+        session = cls._get_session()
+        for batch in _batches(items, batch_size or cls.__batchsize__):
+            mappings = []
+            for item in batch:
+                if isinstance(item, dict):
+                    mappings.append(item)
+                elif isinstance(item, cls):
+                    item.save()
+                else:
+                    raise TypeError(u"Cannot save {!r} as {}".format(item, cls.__name__))
+            if mappings:
+                # the instances first, the dicts may reference them
+                session.flush()
+                session.bulk_insert_mappings(cls, mappings)
+                _mark_written(session, cls.__table__.name)
 
     def merge(self, load=True):
         """
@@ -356,23 +772,100 @@ class CAutomappingActiveDomainObject(object):
         session.merge(cls(**kwargs), load=load)
 
     @classmethod
-    def merge_all(cls, items, load=True):
+    def merge_all(cls, items, load=True, batch_size=None):
         """
         Transfers state from an outside object into a new
         or already existing instance within a session.
+        With load=True dicts are merged batch_size at a time: the primary keys already
+        in the database are fetched with a single IN query per batch, then existing
+        rows are updated with bulk_update_mappings() and new ones inserted with
+        bulk_insert_mappings(). Dicts without a complete primary key (e.g. a serial
+        id left to the database) are always inserted, one row each. Dicts whose primary
+        key is not of the Python type of its columns (e.g. '1' for an integer) cannot be
+        compared with the fetched keys: they are merged one at a time, as with merge_by().
+        As with save_all(), this bypasses the unit of work.
         @param items: items to be merged
         @param load: check also database for primary key
+        @param batch_size: dicts per batch, defaults to __batchsize__
         """
         if not isinstance(items, collections.Iterable):
             items = [items, ]
-        for item in items:
-            if isinstance(item, dict):
-                cls.merge_by(load, **item)
-            elif isinstance(item, cls):
-                item.merge(load)
-            else:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                raise exc_type, exc_value, exc_traceback
+        session = cls._get_session()
+        for batch in _batches(items, batch_size or cls.__batchsize__):
+            mappings = collections.OrderedDict()
+            keyless = []
+            for item in batch:
+                if isinstance(item, dict) and load:
+                    primary_key = cls._primary_key_of(item)
+                    if None in primary_key:
+                        keyless.append(item)
+                    elif not cls._is_typed_key(primary_key):
+                        cls.merge_by(load, **item)
+                    else:
+                        # the same primary key twice in a batch: later values win, like repeated merges
+                        mappings.setdefault(primary_key, {}).update(item)
+                elif isinstance(item, dict):
+                    cls.merge_by(load, **item)
+                elif isinstance(item, cls):
+                    item.merge(load)
+                else:
+                    raise TypeError(u"Cannot merge {!r} as {}".format(item, cls.__name__))
+            if mappings or keyless:
+                # the instances first, the dicts may reference them
+                session.flush()
+                existing = cls._existing_primary_keys(mappings.keys()) if mappings else set()
+                updates = [m for key, m in mappings.iteritems() if key in existing]
+                inserts = [m for key, m in mappings.iteritems() if key not in existing] + keyless
+                if updates:
+                    session.bulk_update_mappings(cls, updates)
+                if inserts:
+                    session.bulk_insert_mappings(cls, inserts)
+                _mark_written(session, cls.__table__.name)
+
+    @classmethod
+    def _primary_key_of(cls, item):
+        """
+        Return the primary key of a dict, as a tuple.
+        """
+        mapper = cls.inspect()
+        return tuple(item.get(mapper.get_property_by_column(column).key) for column in mapper.primary_key)
+
+    @classmethod
+    def _is_typed_key(cls, key):
+        """
+        Return whether every value of the primary key has the Python type of its column,
+        i.e. compares equal to the value read from the database.
+        """
+        for column, value in zip(cls.inspect().primary_key, key):
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:
+                continue
+            if python_type in (int, long):
+                python_type = (int, long)
+            elif python_type in (str, unicode):
+                python_type = basestring
+            elif python_type is datetime.date and isinstance(value, datetime.datetime):
+                return False
+            if not isinstance(value, python_type):
+                return False
+        return True
+
+    @classmethod
+    def _existing_primary_keys(cls, keys):
+        """
+        Return which of the given primary keys are in the database, with a single query.
+        @param keys: primary keys, as tuples
+        @rtype: set
+        """
+        mapper = cls.inspect()
+        columns = mapper.primary_key
+        session = cls._get_session()
+        if len(columns) == 1:
+            condition = columns[0].in_([key[0] for key in keys])
+        else:
+            condition = tuple_(*columns).in_(keys)
+        return set(tuple(row) for row in session.query(*columns).filter(condition))
 
     def delete(self):
         """
@@ -388,7 +881,7 @@ class CAutomappingActiveDomainObject(object):
         then mark those items as deleted.
         @param kwargs: query conditions
         """
-        instances = cls.load(**kwargs)
+        instances = cls.query().filter_by(**kwargs)
         cls.delete_all(instances)
 
     @classmethod
@@ -428,11 +921,13 @@ class CAutomappingActiveDomainObject(object):
     def commit(cls):
         """
         Commit current session.
+        Invalidates the QueryCache entries of the tables written.
         """
         session = cls._get_session()
         try:
             session.commit()
         except SQLAlchemyError:
+            _written_tables(session)
             session.rollback()
             exc_type, exc_value, exc_traceback = sys.exc_info()
             raise exc_type, exc_value, exc_traceback
@@ -440,18 +935,40 @@ class CAutomappingActiveDomainObject(object):
             #     pass
             # except SQLAlchemyError:
             #     raise exc_type, exc_value, exc_traceback
+        QueryCache.invalidate(_written_tables(session))
+
+    @classmethod
+    def rollback(cls):
+        """
+        Rollback current session.
+        """
+        session = cls._get_session()
+        try:
+            session.rollback()
+        except SQLAlchemyError:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            raise exc_type, exc_value, exc_traceback
+
+    @classmethod
+    def _engine_name(cls):
+        return cls.__enginename__ or SessionPool.get_default_engine()
+
+    @classmethod
+    def _engine_url(cls):
+        return str(SessionPool.get_engine(cls._engine_name()).url)
 
     @classmethod
-    def _get_session(cls):
+    def _get_session(cls, readonly=False):
         """
         Return session from default session pool.
+        @param readonly: if True, the session may be bound to a read-only replica
         @return: session
         @rtype: sqlalchemy.orm.session.Session
         """
         engine_name = cls.__enginename__
         if not engine_name:
             engine_name = SessionPool.get_default_engine()
-        session = SessionPool.get_session(engine_name)
+        session = SessionPool.get_session(engine_name, readonly=readonly)
         return session
 
     @classmethod
@@ -498,31 +1015,82 @@ class CAutomappingActiveDomainObject(object):
         print string
 
 
+def _batches(iterable, size):
+    """
+    Yield lists of at most size items of iterable.
+    """
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _as_columns(query):
+    """
+    Rewrites a query to select plain columns instead of mapped instances.
+    Return the new query and the dict keys of its columns: the column names of a
+    single mapped entity, 'table_name.column_name' when several entities are queried
+    together (i.e. joined queries), to avoid duplicate names.
+    """
+    descriptions = query.column_descriptions
+    prefix = len(descriptions) > 1
+    columns, keys = [], []
+    for description in descriptions:
+        expr = description['expr']
+        if isinstance(expr, type) and hasattr(expr, '__table__'):
+            for column in expr.__table__.columns:
+                columns.append(getattr(expr, column.name))
+                keys.append('{}.{}'.format(expr.__table__.name, column.name) if prefix else str(column.name))
+        else:
+            columns.append(expr)
+            keys.append(str(description['name']))
+    return query.with_entities(*columns), keys
+
+
+def _as_dict(keys, row):
+    return dict(zip(keys, (str(value) if isinstance(value, unicode) else value for value in row)))
+
+
+def iter_dicts(query, yield_per=None):
+    """
+    Yields the rows of a query as dicts, with the same keys as to_list_of_dict(),
+    fetching yield_per rows at a time from a server-side cursor.
+    @param query: query to run
+    @param yield_per: rows per fetch, defaults to CAutomappingActiveDomainObject.__batchsize__
+    """
+    query, keys = _as_columns(query)
+    for row in query.yield_per(yield_per or CAutomappingActiveDomainObject.__batchsize__):
+        yield _as_dict(keys, row)
+
+
 def to_list_of_dict(fn):
     """
     Decorator. Convert Query objects into list of dicts.
+    The query is run once, selecting plain columns instead of mapped instances.
     """
     def decorator(*args, **kwargs):
         query = fn(*args, **kwargs)
-        if not len([q for q in query]) or not isinstance(query, Query):
-            # no elements or invalid
+        if not isinstance(query, Query):
+            # invalid
             return None
-        elif isinstance(query[0], KeyedTuple):
-            # list of tuples of caado (from joined query)
-            res = []
-            for tup in query:
-                merged_dict = {}
-                for caado in tup:
-                    # here we merge attributes from different tables into one dict
-                    # so, to avoid duplicate names, we use the name of the table
-                    # as prefix for attribute names (i.e. 'table_name.attribute.name')
-                    for k, v in caado.__iter__(with_prefix=True):
-                        merged_dict[k] = v
-                res.append(merged_dict)
-            return res
-        else:
-            # simple query object
-            return [dict(caado) for caado in query]
+        query, keys = _as_columns(query)
+        # no elements: None
+        return [_as_dict(keys, row) for row in query] or None
+    return decorator
+
+
+def to_iter_of_dict(fn):
+    """
+    Decorator. Convert Query objects into generators of dicts, see iter_dicts().
+    Unlike to_list_of_dict(), memory does not grow with the number of rows.
+    """
+    def decorator(*args, **kwargs):
+        query = fn(*args, **kwargs)
+        if not isinstance(query, Query):
+            return iter([])
+        return iter_dicts(query)
     return decorator
 
 
@@ -556,13 +1124,20 @@ class CAutomappingMetaClass(type):
 
 
 class CAutomappingBase(object):
+    """
+    Reflects the database and prepares the automap base.
+    If cache_dir is given, the reflected MetaData is pickled there, keyed by
+    engine URL and reflected tables, together with the schema fingerprint:
+    as long as the fingerprint does not change, the next reflect() reloads it
+    from disk instead of querying the whole catalog again.
+    """
 
-    def __init__(self, engine_name):
+    def __init__(self, engine_name, cache_dir=None):
         self.engine = SessionPool.get_engine(engine_name)
+        self.cache_dir = cache_dir
 
     def reflect(self, only=None):
-        metadata = MetaData()
-        metadata.reflect(self.engine, only=only)
+        metadata = self._cached_metadata(only)
         Base = automap_base(metadata=metadata)
         Base.prepare(
             classname_for_table=classname_for_table,
@@ -572,6 +1147,92 @@ class CAutomappingBase(object):
         )
         return Base
 
+    def _cached_metadata(self, only=None):
+        """
+        Return the reflected MetaData, from the cache if it is still valid.
+        @param only: names of the tables to reflect, None for all of them;
+                     the ones missing from the database are left out
+        @rtype: sqlalchemy.MetaData
+        """
+        fingerprint = schema_fingerprint(self.engine, only) if self.cache_dir else None
+        if fingerprint is None:
+            return self._reflect(only)
+
+        key = hashlib.sha1(repr((str(self.engine.url), sorted(only or []), sqlalchemy.__version__))).hexdigest()
+        path = os.path.join(self.cache_dir, '{}.pickle'.format(key))
+        try:
+            with open(path, 'rb') as f:
+                cached_fingerprint, metadata = pickle.load(f)
+            if cached_fingerprint == fingerprint:
+                return metadata
+        except Exception:
+            # missing, corrupted or written by another SQLAlchemy version: reflect again
+            pass
+
+        metadata = self._reflect(only)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump((fingerprint, metadata), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            getLogger(__name__).warning(u"Could not cache the reflected schema: {}".format(e))
+        return metadata
+
+    def _reflect(self, only=None):
+        metadata = MetaData()
+        # A predicate rather than the list, which would fail on the tables that do not exist
+        metadata.reflect(self.engine, only=None if only is None else lambda table_name, _: table_name in only)
+        return metadata
+
+
+def schema_fingerprint(engine, only=None):
+    """
+    Return a hash that changes whenever a table, a column or a constraint
+    of the schema changes, computed with a single cheap catalog query.
+    None if the dialect is not supported.
+    @param engine: engine to inspect
+    @param only: names of the reflected tables, None for all of them: the
+                 tables they reference are watched too, the others are not
+    @rtype: basestring or None
+    """
+    if engine.dialect.name == 'postgresql':
+        # every DDL statement writes a new version of the catalog rows, and so changes their xmin
+        query = text("""
+            WITH schemas AS (
+                SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = ANY (current_schemas(false))
+            ), tables AS (
+                SELECT c.oid FROM pg_catalog.pg_class c
+                WHERE c.relnamespace IN (SELECT oid FROM schemas) AND c.relkind IN ('r', 'v', 'm', 'f', 'p')
+                AND (CAST(:names AS text[]) IS NULL OR c.relname::text = ANY (CAST(:names AS text[])))
+            ), reflected AS (
+                SELECT oid FROM tables
+                UNION
+                SELECT k.confrelid FROM pg_catalog.pg_constraint k
+                WHERE k.contype = 'f' AND k.conrelid IN (SELECT oid FROM tables)
+            )
+            SELECT md5(coalesce(string_agg(item, ',' ORDER BY item), '')) FROM (
+                SELECT 'c' || c.oid::text || ':' || c.xmin::text AS item
+                FROM pg_catalog.pg_class c
+                WHERE c.oid IN (SELECT oid FROM reflected)
+                UNION ALL
+                SELECT 'a' || a.attrelid::text || '.' || a.attnum::text || ':' || a.xmin::text
+                FROM pg_catalog.pg_attribute a
+                WHERE a.attrelid IN (SELECT oid FROM reflected) AND a.attnum > 0
+                UNION ALL
+                SELECT 'k' || k.oid::text || ':' || k.xmin::text
+                FROM pg_catalog.pg_constraint k
+                WHERE k.conrelid IN (SELECT oid FROM reflected)
+            ) items
+        """).bindparams(names=None if only is None else sorted(only))
+    elif engine.dialect.name == 'sqlite':
+        query = text('PRAGMA schema_version')
+    else:
+        return None
+    with engine.connect() as connection:
+        return str(connection.execute(query).scalar())
+
 
 def _gen_relationship(base, direction, return_fn, attrname, local_cls, referred_cls, **kwargs):
     """
@@ -618,34 +1279,118 @@ def name_for_collection_relationship(base, local_cls, referred_cls, constraint):
     return referred_cls.__name__.lower() + "_col"
 
 
+class CAutomappedTables(collections.Mapping):
+    """
+    Read-only dict of the mapped tables: table name -> mapped class.
+    Nothing is reflected until the first access, which reflects and maps all
+    the tables of only= together in one automap base, so that the mapped
+    classes and their relationships (in both directions) are the same
+    whichever table is looked up first. Pass only= to keep the cost of
+    automap() proportional to the tables actually used.
+    """
+
+    def __init__(self, db_name, only=None, cache_dir=None, mixins=None):
+        """
+        @param db_name: engine identifier
+        @param only: names of the tables that can be mapped, None for all of them
+        @param cache_dir: directory of the reflection cache, see CAutomappingBase
+        @param mixins: table name -> class whose methods are added to the mapped class
+        """
+        self.db_name = db_name
+        self.only = only
+        self.cache_dir = cache_dir
+        self.mixins = mixins or {}
+        self._tables = {}
+        self._table_names = None
+        self._base = None
+
+    def __getitem__(self, table_name):
+        if table_name not in self._tables:
+            if table_name not in self:
+                raise KeyError(table_name)
+            Base = self.base()
+            if not hasattr(Base.classes, table_name):
+                raise InvalidRequestError(u"Table {} not found in {}".format(table_name, self.db_name))
+            self._tables[table_name] = _activate(getattr(Base.classes, table_name), self.db_name,
+                                                 mixin=self.mixins.get(table_name))
+        return self._tables[table_name]
+
+    def base(self):
+        """
+        Return the automap base of all the tables, reflecting them on the first call.
+        The tables of only= missing from the database are left out.
+        """
+        if self._base is None:
+            self._base = CAutomappingBase(self.db_name, cache_dir=self.cache_dir).reflect(only=self.only)
+        return self._base
+
+    def __contains__(self, table_name):
+        return table_name in self.table_names()
+
+    def __iter__(self):
+        return iter(self.table_names())
+
+    def __len__(self):
+        return len(self.table_names())
+
+    def table_names(self):
+        """
+        Return the names of the tables that can be mapped, without reflecting them.
+        @rtype: list
+        """
+        if self._table_names is None:
+            if self.only is not None:
+                self._table_names = list(self.only)
+            else:
+                self._table_names = inspect(SessionPool.get_engine(self.db_name)).get_table_names()
+        return self._table_names
+
+
+def _activate(Table, db_name, mixin=None):
+    """
+    Turns a class mapped by automap into a CAutomappingActiveDomainObject.
+    The attributes of mixin, if given, are added as well.
+    """
+    namespace = {
+        '__enginename__': db_name,
+        '__tablename__': Table.__name__,
+    }
+    for key, value in namespace.iteritems():
+        if key not in ['__tablename__']:
+            setattr(Table, key, value)
+    for key, value in CAutomappingActiveDomainObject.__dict__.iteritems():
+        if key not in ['__dict__', '__enginename__', '__tablename__']:
+            setattr(Table, key, value)
+    if mixin is not None:
+        for key, value in mixin.__dict__.iteritems():
+            if key not in ['__dict__', '__weakref__', '__module__', '__doc__']:
+                setattr(Table, key, value)
+    return Table
+
+
 def automap(db_name, endpoint, **kwargs):
+    """
+    Return the tables of the database as CAutomappingActiveDomainObject classes.
+    @param db_name: engine identifier, the engine is created if necessary
+    @param endpoint: URL of the database
+    @param kwargs: only (table names to map), cache_dir (see CAutomappingBase),
+                   mixins (table name -> class with methods to add to the mapped class),
+                   echo and the others for CScopedSessionPool.new_engine()
+    @return: table name -> mapped class, mapped on first access
+    @rtype: CAutomappedTables
+    """
 
     only = kwargs.pop('only', None)
     echo = kwargs.pop('echo', False)
+    cache_dir = kwargs.pop('cache_dir', None)
+    mixins = kwargs.pop('mixins', None)
 
-    # create the engine if necessary
+    # create the engine if necessary, the other kwargs configure it
     if db_name not in SessionPool.engines:
-        SessionPool.new_engine(db_name, endpoint, echo=echo)
-
-    # sqlalchemy reflection
-    Base = CAutomappingBase(db_name).reflect()
-
-    tables = {}
-    for Table in Base.classes:
-        table_name = Table.__name__
-        if only is None or table_name in only:
-            namespace = {
-                '__enginename__': db_name,
-                '__tablename__': table_name,
-            }
-            for key, value in namespace.iteritems():
-                if key not in ['__tablename__']:
-                    setattr(Table, key, value)
-            for key, value in CAutomappingActiveDomainObject.__dict__.iteritems():
-                if key not in ['__dict__', '__enginename__', '__tablename__']:
-                    setattr(Table, key, value)
-            tables[table_name] = Table
-    return tables
+        SessionPool.new_engine(db_name, endpoint, echo=echo, **kwargs)
+
+    # the tables of only= are reflected together, in one pass, on the first access
+    return CAutomappedTables(db_name, only=only, cache_dir=cache_dir, mixins=mixins)
 
 
 if __name__ == '__main__':
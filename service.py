@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import BaseHTTPServer
+import datetime
+import hashlib
+import re
+import select
+import SocketServer
+import threading
+import time
+import urlparse
+from logging import getLogger
+
+__all__ = ['CReportCache', 'CReportHandler', 'CReportServer', 'listen']
+
+
+class CReportCache(object):
+    """
+    Rendered reports of the service: (badge, date, maw, format) -> (ETag, body), until they
+    expire or a notification of scrape or load tells that the day changed.
+    Every notification also moves the generation of its day on: a report rendered
+    before it, and set after it, would be stale, and is not cached.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._generations = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self, badge, date):
+        """
+        Return the generation of the day, to pass to set() with the report rendered after it.
+        """
+        with self._lock:
+            return self._generation, self._generations.get((badge, str(date)), 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[2] < time.time():
+            return None
+        return entry[:2]
+
+    def set(self, key, body, expires, generation=None):
+        entry = '"{}"'.format(hashlib.sha1(body).hexdigest()), body, expires
+        with self._lock:
+            if generation is not None and generation != (self._generation, self._generations.get((key[0], str(key[1])), 0)):
+                return entry[:2]
+            if len(self._entries) >= self.max_entries:
+                now = time.time()
+                for expired in [k for k, (_, _, e) in self._entries.iteritems() if e < now]:
+                    del self._entries[expired]
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = entry
+        return entry[:2]
+
+    def invalidate(self, payload):
+        """
+        Drop the entries of a notified 'badge date' day, or all of them with '*'.
+        """
+        with self._lock:
+            if payload == '*':
+                self._entries.clear()
+                self._generations.clear()
+                self._generation += 1
+                return
+            badge, date = payload.split()
+            self._generations[badge, date] = self._generations.get((badge, date), 0) + 1
+            for key in [key for key in self._entries if key[0] == badge and str(key[1]) == date]:
+                del self._entries[key]
+
+
+class CReportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /<badge>[/<YYYY-MM-DD>][?maw=1][&format=json]: the report of the day, today by default.
+    HEAD sends the same headers without the body.
+    """
+
+    path_pattern = re.compile(r'^/(\w+)(?:/(\d{4}-\d{2}-\d{2}))?/?$')
+
+    def do_GET(self):
+        self.send_report(body=True)
+
+    def do_HEAD(self):
+        self.send_report(body=False)
+
+    def send_report(self, body=True):
+        url = urlparse.urlparse(self.path)
+        match = self.path_pattern.match(url.path)
+        if not match:
+            return self.send_error(404)
+        badge, date = match.groups()
+        try:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date() if date else datetime.date.today()
+        except ValueError:
+            return self.send_error(400, "Data non valida")
+        query = urlparse.parse_qs(url.query)
+        maw = query['maw'][0] in ('1', 'true') if 'maw' in query else self.server.maw
+        format = 'json' if query.get('format') == ['json'] else 'text'
+
+        key = (badge, date, maw, format)
+        entry = self.server.cache.get(key)
+        if entry is None:
+            generation = self.server.cache.generation(badge, date)
+            try:
+                rendered = self.server.render(badge, date, maw=maw, format=format)
+            except Exception as e:
+                getLogger(__name__).exception(u"Could not render the report of {} for {}: {}".format(badge, date, e))
+                return self.send_error(500)
+            finally:
+                self.server.release()
+            # Today's report counts the hours up to now: render it again every minute
+            expires = time.time() // 60 * 60 + 60 if date == datetime.date.today() else time.time() + self.server.ttl
+            entry = self.server.cache.set(key, rendered, expires, generation)
+
+        etag, content = entry
+        if self.etag_matches(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if format == 'json' else 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def etag_matches(self, etag):
+        """
+        Whether If-None-Match lists etag: the weak comparison of RFC 7232, '*' matching any.
+        """
+        tags = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+    def address_string(self):
+        # The default looks the client name up in the DNS, on every request
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        getLogger(__name__).debug(u"[serve] {} {}".format(self.address_string(), format % args))
+
+
+class CReportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server of the reports.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, render, release, maw=False, ttl=3600):
+        """
+        @param address: (host, port) to listen on
+        @param render: function(badge, date, maw, format) returning the body of a report
+        @param release: called in the request thread after rendering, e.g. to give back its session
+        @param maw: default of the maw parameter
+        @param ttl: seconds the reports of the past days are cached for
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, CReportHandler)
+        self.render = render
+        self.release = release
+        self.maw = maw
+        self.ttl = ttl
+        self.cache = CReportCache()
+
+
+def listen(engine, channel, cache):
+    """
+    Thread body: drop the cached reports of the days notified on channel by scrape and load.
+    @param engine: PostgreSQL engine, one of its connections is kept for LISTEN
+    @param channel: notification channel
+    @param cache: CReportCache to invalidate
+    """
+    logger = getLogger(__name__)
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            connection.connection.set_isolation_level(0)
+            connection.cursor().execute('LISTEN {}'.format(channel))
+            # Anything may have changed while not listening
+            cache.invalidate('*')
+            logger.info(u"[serve] Listening for the changed days")
+            while True:
+                if select.select([connection.connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.connection.poll()
+                while connection.connection.notifies:
+                    cache.invalidate(connection.connection.notifies.pop(0).payload)
+        except Exception as e:
+            logger.exception(u"[serve] Lost the notifications: {}".format(e))
+            if connection is not None:
+                connection.invalidate()
+            time.sleep(5)
+
+
+if __name__ == '__main__':
+    pass
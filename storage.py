@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+How the punches are stored in PostgreSQL: monthly partitions of abaita, the
+compressed archive of the raw lines, the inserts of scrape and load and the
+notifications of the changed days. Imported by the subcommands that need it,
+not to load SQLAlchemy on every invocation.
+"""
+
+import collections
+import datetime
+import zlib
+from logging import getLogger
+
+from sqlalchemy import LargeBinary, bindparam, text
+from sqlalchemy.dialects.postgresql import insert
+
+from metrics import Metrics
+from orm import SessionPool
+
+__all__ = [
+    'PunchMixin',
+    'copy_rows',
+    'create_partitions',
+    'ingest',
+    'is_partitioned',
+    'migrate_table',
+    'notify_days',
+    'pack_days',
+    'partitions',
+    'read_block',
+    'supports_partitioning',
+]
+
+# Table name -> months with a partition, None if the table is not partitioned
+partitions = {}
+
+# Block id -> lines of the archived raw lines, see read_block()
+raw_blocks = {}
+raw_blocks_size = 64
+
+# Channel of the notifications of the changed days, more than notify_limit days invalidate everything
+notify_channel = 'abaita'
+notify_limit = 1000
+
+_logger = getLogger(__name__)
+
+
+def month_start(date):
+    return date.replace(day=1)
+
+
+def next_month(date):
+    return month_start(month_start(date) + datetime.timedelta(days=32))
+
+
+def supports_partitioning(CAbaita):
+    # Primary keys and indexes on a partitioned table need PostgreSQL 11
+    return CAbaita.connection().dialect.server_version_info >= (11,)
+
+
+def is_partitioned(CAbaita):
+    table = CAbaita.__table__.name
+    if table not in partitions:
+        partitioned = supports_partitioning(CAbaita) and CAbaita.execute(text(
+            'SELECT EXISTS (SELECT 1 FROM pg_catalog.pg_partitioned_table WHERE partrelid = to_regclass(:table))'
+        ), dict(table=table)).scalar()
+        partitions[table] = set() if partitioned else None
+    return partitions[table] is not None
+
+
+def create_partitions(CAbaita, dates):
+    """
+    Create the monthly partitions the given dates fall in, if abaita is partitioned.
+    """
+    if not is_partitioned(CAbaita):
+        return
+    table = CAbaita.__table__.name
+    for month in sorted(set(month_start(date) for date in dates) - partitions[table]):
+        _logger.debug(u"Creating the partition of {} for {:%Y-%m}".format(table, month))
+        CAbaita.execute(text(
+            "CREATE TABLE IF NOT EXISTS {0}_{1:%Y_%m} PARTITION OF {0} FOR VALUES FROM ('{1}') TO ('{2}')".format(
+                table, month, next_month(month))
+        ))
+        partitions[table].add(month)
+
+
+def partition_table(CAbaita):
+    """
+    Turn abaita into a table partitioned by month, moving the rows into the new partitions.
+    """
+    table = CAbaita.__table__.name
+    _logger.info(u"Partitioning {} by month".format(table))
+    CAbaita.execute(text('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(table)))
+    CAbaita.execute(text('ALTER TABLE {0} RENAME TO {0}_unpartitioned'.format(table)))
+    CAbaita.execute(text('ALTER TABLE {0}_unpartitioned RENAME CONSTRAINT {0}_pkey TO {0}_unpartitioned_pkey'.format(table)))
+    CAbaita.execute(text('DROP INDEX IF EXISTS {}_badge_date_time_idx'.format(table)))
+    CAbaita.execute(text('CREATE TABLE {0} (LIKE {0}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (date)'.format(table)))
+    CAbaita.execute(text('ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY (date, "time", badge)'.format(table)))
+    partitions[table] = set()
+    months = CAbaita.execute(text("SELECT DISTINCT date_trunc('month', date)::date FROM {}_unpartitioned".format(table)))
+    create_partitions(CAbaita, [month for month, in months])
+    CAbaita.execute(text('INSERT INTO {0} SELECT * FROM {0}_unpartitioned'.format(table)))
+    CAbaita.execute(text('DROP TABLE {}_unpartitioned'.format(table)))
+
+
+def save_block(CAbaita, lines):
+    """
+    Save the lines as one compressed block of the archive, return its id.
+    """
+    statement = text('INSERT INTO {}_raw (data) VALUES (:data) RETURNING id'.format(CAbaita.__table__.name))
+    statement = statement.bindparams(bindparam('data', type_=LargeBinary))
+    return CAbaita.execute(statement, dict(data=zlib.compress('\n'.join(lines)))).scalar()
+
+
+def read_block(CAbaita, block):
+    if block not in raw_blocks:
+        if len(raw_blocks) >= raw_blocks_size:
+            raw_blocks.clear()
+        # From the primary: a replica may not have the blocks written just before yet
+        data = CAbaita.execute(text('SELECT data FROM {}_raw WHERE id = :id'.format(CAbaita.__table__.name)),
+                               dict(id=block)).scalar()
+        if data is None:
+            # e.g. a row read from a replica that still points to a block packed since
+            raise LookupError(u"Block {} of the raw lines not found in {}_raw".format(block, CAbaita.__table__.name))
+        raw_blocks[block] = zlib.decompress(data).split('\n')
+    return raw_blocks[block]
+
+
+class PunchMixin(object):
+    """
+    Methods of the mapped abaita class, added by automap().
+    """
+
+    def get_raw(self):
+        """
+        The original line of the punch, rebuilt from the archive if it is not stored inline.
+        """
+        if self.raw is not None or getattr(self, 'raw_block', None) is None:
+            return self.raw
+        return read_block(type(self), self.raw_block)[self.raw_offset]
+
+
+def pack_days(CAbaita, dates):
+    """
+    Archive the raw lines of each of the given days of abaita in a single block, the inline
+    ones and the ones of the blocks written before, which are dropped once empty.
+    Return the number of inline lines moved to the archive.
+    """
+    table = CAbaita.__table__.name
+    count = 0
+    for date in sorted(set(dates)):
+        rows = CAbaita.execute(text(
+            'SELECT raw, raw_block, raw_offset FROM {} WHERE date = :date '
+            'AND (raw IS NOT NULL OR raw_block IS NOT NULL) ORDER BY "time", badge'.format(table)
+        ), dict(date=date)).fetchall()
+        lines = [raw if raw is not None else read_block(CAbaita, old)[offset] for raw, old, offset in rows]
+        used = collections.Counter(old for raw, old, offset in rows if raw is None)
+        block = save_block(CAbaita, lines)
+        # Numbered in the same order as the lines of the block, matched by primary key:
+        # a ctid is unique only within one partition
+        CAbaita.execute(text(
+            'UPDATE {0} SET raw = NULL, raw_block = :block, raw_offset = numbered.n - 1 FROM ('
+            'SELECT "time", badge, row_number() OVER (ORDER BY "time", badge) AS n '
+            'FROM {0} WHERE date = :date AND (raw IS NOT NULL OR raw_block IS NOT NULL)'
+            ') numbered WHERE {0}.date = :date '
+            'AND {0}."time" = numbered."time" AND {0}.badge = numbered.badge'.format(table)
+        ), dict(block=block, date=date))
+        # A block that also holds lines of other days is still in use
+        empty = [old for old, n in used.iteritems() if n == len(read_block(CAbaita, old))]
+        if empty:
+            CAbaita.execute(text('DELETE FROM {}_raw WHERE id = ANY (:blocks)'.format(table)), dict(blocks=empty))
+        count += len(rows) - sum(used.itervalues())
+    return count
+
+
+def migrate_table(CAbaita, partition=False, archive=False):
+    """
+    Bring abaita up to date: the badge index, the archive table and columns, inserted_at and,
+    on request, the monthly partitions and the archive of the inline raw lines,
+    which also packs the days archived in several blocks into one.
+    Return the number of raw lines archived.
+    """
+    table = CAbaita.__table__.name
+    if partition and not is_partitioned(CAbaita):
+        partition_table(CAbaita)
+    # Covering the report queries, which always filter on the badge
+    CAbaita.execute(text('CREATE INDEX IF NOT EXISTS {0}_badge_date_time_idx ON {0} (badge, date, "time", uscita)'.format(table)))
+    # Compressed blocks of raw lines, see pack_days()
+    CAbaita.execute(text('CREATE TABLE IF NOT EXISTS {}_raw (id serial PRIMARY KEY, data bytea NOT NULL)'.format(table)))
+    CAbaita.execute(text('ALTER TABLE {} ADD COLUMN IF NOT EXISTS raw_block integer, ADD COLUMN IF NOT EXISTS raw_offset integer'.format(table)))
+    # When the row was saved, for the incremental sync of the local stores
+    CAbaita.execute(text('ALTER TABLE {} ADD COLUMN IF NOT EXISTS inserted_at timestamptz NOT NULL DEFAULT now()'.format(table)))
+    count = 0
+    if archive:
+        days = CAbaita.execute(text(
+            'SELECT date FROM {} WHERE raw IS NOT NULL OR raw_block IS NOT NULL GROUP BY date '
+            'HAVING bool_or(raw IS NOT NULL) OR count(DISTINCT raw_block) > 1'.format(table)
+        ))
+        count = pack_days(CAbaita, [date for date, in days])
+        _logger.info(u"Archived {} raw lines".format(count))
+    CAbaita.execute(text('ANALYZE {}'.format(table)))
+    return count
+
+
+def ingest(CAbaita, batches, archive=False):
+    """
+    Insert the batches of records, letting the primary key drop the ones already saved.
+    With archive, the raw lines of the days that got new rows are then packed in one
+    compressed block per day, see pack_days().
+    Return the (date, time, badge) keys of the inserted rows and the number of skipped records.
+    """
+    table = CAbaita.__table__
+    statement = insert(table).on_conflict_do_nothing(index_elements=list(table.primary_key.columns))
+    statement = statement.returning(table.c.date, table.c.time, table.c.badge)
+
+    inserted, skipped = [], 0
+    for batch in batches:
+        rows = [dict(date=date, time=time, badge=badge, uscita=uscita, raw=raw) for date, time, badge, uscita, raw in batch]
+        create_partitions(CAbaita, [r['date'] for r in rows])
+        with Metrics.span('insert'):
+            keys = [tuple(r) for r in CAbaita.execute(statement.values(rows))]
+        inserted.extend(keys)
+        skipped += len(rows) - len(keys)
+    if archive and inserted:
+        # Once per day and not per batch: a few lines do not compress
+        with Metrics.span('archive'):
+            pack_days(CAbaita, [date for date, _, _ in inserted])
+    Metrics.count('rows_inserted', len(inserted))
+    Metrics.count('rows_duplicate', skipped)
+    return inserted, skipped
+
+
+def copy_rows(CAbaita, stream, archive=False):
+    """
+    COPY the stream (see CopyStream) into a staging table, then merge it into abaita
+    letting the primary key drop the duplicates. With archive, the raw lines of the
+    days that got new rows are then packed in one block per day, see pack_days().
+    Return badge, date and number of inserted rows of every day that got new rows.
+    """
+    table = CAbaita.__table__.name
+    CAbaita.execute(text('CREATE TEMPORARY TABLE {0}_staging (LIKE {0} INCLUDING DEFAULTS) ON COMMIT DROP'.format(table)))
+    cursor = CAbaita.connection().connection.cursor()
+    with Metrics.span('copy'):
+        cursor.copy_expert('COPY {}_staging (date, "time", badge, uscita, raw) FROM STDIN'.format(table), stream)
+    months = CAbaita.execute(text("SELECT DISTINCT date_trunc('month', date)::date FROM {}_staging".format(table)))
+    create_partitions(CAbaita, [month for month, in months])
+    with Metrics.span('insert'):
+        days = CAbaita.execute(text(
+            'WITH inserted AS ('
+            'INSERT INTO {0} (date, "time", badge, uscita, raw) '
+            'SELECT date, "time", badge, uscita, raw FROM {0}_staging '
+            'ON CONFLICT DO NOTHING '
+            'RETURNING badge, date'
+            ') SELECT badge, date, count(*) FROM inserted GROUP BY badge, date'.format(table)
+        )).fetchall()
+    if archive and days:
+        # Into the blocks of the days already there, as ingest() does
+        with Metrics.span('archive'):
+            pack_days(CAbaita, [date for badge, date, count in days])
+    return days
+
+
+def notify_days(CAbaita, days):
+    """
+    Tell the report services (see serve) which (badge, date) days changed: PostgreSQL
+    delivers the notifications on commit, and only if it commits.
+    """
+    days = sorted(set(days))
+    if not days or SessionPool.get_engine(CAbaita.__enginename__).dialect.name != 'postgresql':
+        return
+    payloads = ['*'] if len(days) > notify_limit else ['{} {}'.format(badge, date) for badge, date in days]
+    CAbaita.execute(text('SELECT pg_notify(:channel, payload) FROM unnest(:payloads) AS payload'),
+                    dict(channel=notify_channel, payloads=payloads))
+
+
+if __name__ == '__main__':
+    pass